@@ -2,13 +2,15 @@
 FastAPI wrapper for RoastBot - For testing with Postman
 """
 
+import hmac
 import os
-from fastapi import FastAPI, HTTPException
+import threading
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from openai import OpenAI
 from dotenv import load_dotenv
 
-from rag import retrieve_context
+from rag import retrieve_context, warmup, rag_status, rebuild, rebuild_status
 from prompt import SYSTEM_PROMPT
 from memory import add_to_memory, format_memory, clear_memory
 
@@ -16,15 +18,41 @@ load_dotenv()
 
 app = FastAPI(title="RoastBot API")
 
-client = OpenAI(
-    base_url="https://api.groq.com/openai/v1",
-    api_key=os.getenv("GROQ_KEY")
-)
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """OpenAI-compatible Groq client, created on the first /chat.
+
+    The openai package takes ~0.5s to import, which /clear, /ready and health
+    checks should not pay for.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(
+                    base_url="https://api.groq.com/openai/v1",
+                    api_key=os.getenv("GROQ_KEY")
+                )
+    return _client
 
 TEMPERATURE = 0.8
 MAX_TOKENS = 512
 MODEL_NAME = "llama-3.1-8b-instant"
 
+# /admin/* requires a matching X-Admin-Token header; unset disables those endpoints
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+@app.on_event("startup")
+def start_rag_warmup():
+    """Build/load the RAG index in the background so the first /chat doesn't pay for it."""
+    warmup(background=True)
+
 
 class ChatRequest(BaseModel):
     message: str
@@ -50,7 +78,7 @@ def chat_endpoint(request: ChatRequest):
             f"Recent conversation for context: {history}"
         )
         
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=MODEL_NAME,
             messages=[
                 {"role": "system", "content": prompt},
@@ -75,6 +103,45 @@ def clear_endpoint():
     return {"message": "Chat history cleared"}
 
 
+@app.get("/ready")
+def ready_endpoint():
+    """Readiness probe: 200 once the RAG index is loaded, 503 while cold/loading/failed.
+
+    The body carries the last warmup error and, while a retry is pending, retry_in_s.
+    """
+    status = rag_status()
+    return JSONResponse(status_code=200 if status["state"] == "ready" else 503, content=status)
+
+
+def _check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post("/admin/rebuild")
+def rebuild_endpoint(full: bool = False, x_admin_token: str = Header(default=None)):
+    """Rebuild the RAG index in the background and hot-swap it in.
+
+    full=false syncs with data/ incrementally; full=true re-embeds everything.
+    Chat keeps being served from the current index meanwhile. Poll
+    GET /admin/rebuild/status for duration_s and the published version.
+    """
+    _check_admin(x_admin_token)
+    if rag_status()["state"] != "ready":
+        raise HTTPException(status_code=503, detail="RAG index is not loaded yet")
+    status = rebuild(full=full, background=True)
+    return JSONResponse(status_code=202 if status["started"] else 409, content=status)
+
+
+@app.get("/admin/rebuild/status")
+def rebuild_status_endpoint(x_admin_token: str = Header(default=None)):
+    """Last rebuild: state, duration_s, version it published, and the live version."""
+    _check_admin(x_admin_token)
+    return rebuild_status()
+
+
 @app.get("/")
 def root():
     return {"message": "RoastBot API - Use POST /chat to get roasted!"}
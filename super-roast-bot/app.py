@@ -11,12 +11,12 @@ New in this version:
 
 import os
 import uuid
+from typing import Optional
 
 import streamlit as st
-from groq import Groq
 from dotenv import load_dotenv
 
-from rag import retrieve_context
+from rag import retrieve_context, forget_session, warmup, rag_status
 from prompt import SYSTEM_PROMPT
 from memory import add_to_memory, format_memory, clear_memory, get_memory
 from utils.roast_mode import get_system_prompt, build_adaptive_prompt
@@ -33,12 +33,24 @@ from database import (
 # ---------------- Environment ---------------- #
 load_dotenv()
 
-# Initialize Groq client
-client = Groq(api_key=os.getenv("GROQ_KEY"))
+
+@st.cache_resource
+def get_client():
+    """Groq client, created once per server process on the first chat turn."""
+    from groq import Groq  # deferred: the first page render doesn't need it
+
+    return Groq(api_key=os.getenv("GROQ_KEY"))
+
 
 TEMPERATURE = float(os.getenv("TEMPERATURE", 0.8))
 MAX_TOKENS  = int(os.getenv("MAX_TOKENS", 512))
 MODEL_NAME  = os.getenv("MODEL_NAME", "llama-3.1-8b-instant")
+# Token budgets for the prompt's roast-context block and chat-history block
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", 1000))
+MAX_HISTORY_TOKENS = 3000
+
+# Start loading the RAG index in the background; no-op once it's loading/ready
+warmup(background=True)
 
 
 # ── Session helpers ────────────────────────────────────────────────────────────
@@ -82,7 +94,7 @@ def _validate_input(user_input):
     return user_input, None
 
 
-def _build_llm_messages(user_input: str, base_system_prompt: str):
+def _build_llm_messages(user_input: str, base_system_prompt: str, mode: Optional[str] = None):
     """
     Shared helper used by both chat() and chat_stream().
     Runs the full adaptive pipeline and returns (messages, importance, profile).
@@ -93,9 +105,10 @@ def _build_llm_messages(user_input: str, base_system_prompt: str):
     profile_snippet = profile.to_prompt_snippet()
     system_prompt   = build_adaptive_prompt(base_system_prompt, profile_snippet)
 
-    context       = retrieve_context(user_input)
+    context       = retrieve_context(user_input, max_context_tokens=MAX_CONTEXT_TOKENS,
+                                     session_id=_get_session_id(), mode=mode)
     raw_memory    = get_memory()
-    trimmed_dicts = trim_chat_history(raw_memory, max_tokens=3000)
+    trimmed_dicts = trim_chat_history(raw_memory, max_tokens=MAX_HISTORY_TOKENS)
 
     messages = [
         {"role": "system", "content": system_prompt},
@@ -108,14 +121,14 @@ def _build_llm_messages(user_input: str, base_system_prompt: str):
     return messages, importance, profile
 
 
-def chat_stream(user_input: str, base_system_prompt: str = SYSTEM_PROMPT):
+def chat_stream(user_input: str, base_system_prompt: str = SYSTEM_PROMPT, mode: Optional[str] = None):
     """
     Streaming variant — yields text chunks as they arrive from the LLM.
 
     Uses the identical adaptive-intelligence pipeline as chat():
       • UserProfile update & importance scoring
       • Adaptive system-prompt injection
-      • RAG context retrieval
+      • RAG context retrieval, filtered to the roast mode
       • Importance-aware memory trimming
       • Persists the completed reply to memory + SQLite after streaming ends
     """
@@ -125,9 +138,9 @@ def chat_stream(user_input: str, base_system_prompt: str = SYSTEM_PROMPT):
         return
 
     try:
-        messages, importance, profile = _build_llm_messages(user_input, base_system_prompt)
+        messages, importance, profile = _build_llm_messages(user_input, base_system_prompt, mode)
 
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=MODEL_NAME,
             messages=messages,
             temperature=TEMPERATURE,
@@ -152,7 +165,7 @@ def chat_stream(user_input: str, base_system_prompt: str = SYSTEM_PROMPT):
         yield f"Even I broke trying to roast you. Error: {str(e)[:100]}"
 
 
-def chat(user_input: str, base_system_prompt: str = SYSTEM_PROMPT) -> str:
+def chat(user_input: str, base_system_prompt: str = SYSTEM_PROMPT, mode: Optional[str] = None) -> str:
     """Non-streaming variant with full adaptive intelligence."""
 
     user_input, err = _validate_input(user_input)
@@ -160,9 +173,9 @@ def chat(user_input: str, base_system_prompt: str = SYSTEM_PROMPT) -> str:
         return err
 
     try:
-        messages, importance, profile = _build_llm_messages(user_input, base_system_prompt)
+        messages, importance, profile = _build_llm_messages(user_input, base_system_prompt, mode)
 
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=MODEL_NAME,
             messages=messages,
             temperature=TEMPERATURE,
@@ -213,6 +226,7 @@ with st.sidebar:
         clear_memory()
         clear_chat_history(sid)
         clear_user_profile(sid)
+        forget_session(sid)
         if "user_profile" in st.session_state:
             del st.session_state["user_profile"]
         st.success("Chat cleared!")
@@ -246,7 +260,8 @@ with st.sidebar:
         "**⚙️ Config (env-based):**\n"
         f"- Model: `{MODEL_NAME}`\n"
         f"- Temp: `{TEMPERATURE}`\n"
-        f"- Max tokens: `{MAX_TOKENS}`"
+        f"- Max tokens: `{MAX_TOKENS}`\n"
+        f"- Roast index: `{rag_status()['state']}`"
     )
 
 
@@ -268,10 +283,10 @@ if user_input := st.chat_input("Say something... if you dare 🔥"):
     with st.chat_message("assistant", avatar="😈"):
         try:
             if enable_streaming:
-                reply = st.write_stream(chat_stream(user_input, base_system_prompt=system_prompt))
+                reply = st.write_stream(chat_stream(user_input, base_system_prompt=system_prompt, mode=mode))
             else:
                 with st.spinner("Cooking up a roast... 🍳"):
-                    reply = chat(user_input, base_system_prompt=system_prompt)
+                    reply = chat(user_input, base_system_prompt=system_prompt, mode=mode)
                     st.markdown(reply)
         except Exception as e:
             reply = f"Even I broke trying to roast you. Error: {e}"
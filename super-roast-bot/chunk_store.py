@@ -0,0 +1,397 @@
+"""
+Compact chunk store — chunk_store.py
+
+Chunk texts and metadata are kept column-wise instead of as one Python object
+per chunk: all texts in a single UTF-8 buffer with an offsets table, and each
+metadata field in a typed array. A Chunk (and its str) is only created for the
+chunks a query actually returns. Per chunk this costs the UTF-8 bytes plus
+~52 bytes of fixed-width columns, versus a frozen dataclass, a str (UCS-4 as
+soon as it holds one 🔥) and a dict slot.
+
+The same columns are written to disk as flat files that any number of
+processes can memory-map read-only, so the OS page cache holds one copy no
+matter how many uvicorn/Streamlit workers serve retrieval:
+
+  chunks.blob          all chunk texts, UTF-8, back to back in insertion order
+  chunks.offsets.npy   uint64[n + 1]; the j-th text in the blob is
+                       blob[offsets[j]:offsets[j + 1]]
+  chunks.meta.npy      one record per chunk (id, source, page, start, end,
+                       token_count, text = j of its text), sorted by id for
+                       binary-search lookup
+  chunks.sources.json  {"sources": source filenames, indexed by meta["source"],
+                        "tags": the tag list of each source}
+  chunks.vectors.npy   optional float32[n, dim] full-precision embeddings in
+                       row order, for exact re-ranking over a quantized index;
+                       always opened memory-mapped, so they stay on disk
+  chunks.minhash.npy   optional uint32[n, perms] MinHash signatures in row
+                       order (dedup.py), also always memory-mapped
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from utils.atomic_files import discard, temp_path_for
+from utils.lazy_import import lazy_module
+
+np = lazy_module("numpy")
+
+_FILES = ("chunks.blob", "chunks.offsets.npy", "chunks.meta.npy", "chunks.sources.json")
+
+# Optional row-aligned matrices: attribute name -> (file, dtype)
+_MATRICES = {
+    "vectors": ("chunks.vectors.npy", "float32"),
+    "minhash": ("chunks.minhash.npy", "uint32"),
+}
+
+# Column name, array typecode (in-memory builder), numpy dtype (on disk)
+_COLUMNS = (
+    ("id", "q", "<i8"),
+    ("source", "I", "<u4"),
+    ("page", "i", "<i4"),         # 0 = not paged (text files); PDF pages are 1-based
+    ("start", "q", "<i8"),
+    ("end", "q", "<i8"),
+    ("token_count", "I", "<u4"),
+    ("text", "Q", "<u8"),         # position of the row's text in the blob (see offsets)
+)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """One retrievable unit of roast material plus where it came from."""
+    id: int
+    text: str
+    source: str
+    page: Optional[int]   # 1-based PDF page, None for text files
+    start: int            # char offsets into the file text (or page text for PDFs)
+    end: int
+    token_count: int
+    tags: tuple = ()      # casefolded tags of its source file (roast mode, topic)
+
+
+class ChunkStore(Mapping):
+    """Read-only {chunk id: Chunk} over column storage, rows sorted by id.
+
+    blob is bytes-like or a read-only mmap; offsets and the columns are array.array
+    (built in memory) or numpy arrays (opened from disk, possibly memmapped).
+    Lookups binary-search the id column; texts are decoded on access.
+    `vectors` (float32 (n, dim) embeddings) and `minhash` (uint32 (n, perms)
+    signatures), when kept, are arrays aligned with the rows.
+
+    Tags are stored once per source; tag_ids() derives the sorted id array
+    of a tag on first use and keeps it, so filters are set operations on
+    those arrays rather than scans of the source column.
+    """
+
+    def __init__(self, blob, offsets, columns: dict, sources: list, vectors=None, minhash=None,
+                 source_tags=None):
+        self._blob = blob
+        self._offsets = offsets
+        self._columns = columns
+        self._ids = columns["id"]
+        self._sources = sources
+        self._source_tags = [tuple(t) for t in source_tags] if source_tags else [()] * len(sources)
+        self._tag_ids = {}
+        self.vectors = vectors
+        self.minhash = minhash
+
+    @classmethod
+    def empty(cls) -> "ChunkStore":
+        return ChunkStoreBuilder().build()
+
+    def _row(self, chunk_id):
+        i = bisect_left(self._ids, chunk_id)
+        if i < len(self._ids) and self._ids[i] == chunk_id:
+            return i
+        return None
+
+    def rows(self, chunk_ids):
+        """Row numbers of chunk_ids as an int64 array, -1 where unknown."""
+        ids = self._ids if isinstance(self._ids, np.ndarray) else np.frombuffer(self._ids, dtype="<i8")
+        chunk_ids = np.asarray(chunk_ids, dtype="int64")
+        rows = np.searchsorted(ids, chunk_ids)
+        found = rows < len(ids)
+        found[found] = ids[rows[found]] == chunk_ids[found]
+        return np.where(found, rows, -1)
+
+    def _text_at(self, i) -> str:
+        j = int(self._columns["text"][i])
+        return bytes(self._blob[int(self._offsets[j]):int(self._offsets[j + 1])]).decode("utf-8")
+
+    def text(self, chunk_id) -> str:
+        """Just the text of a chunk, without building the Chunk."""
+        i = self._row(chunk_id)
+        if i is None:
+            raise KeyError(chunk_id)
+        return self._text_at(i)
+
+    def _meta_at(self, i) -> dict:
+        c = self._columns
+        sid = int(c["source"][i])
+        return {
+            "source": self._sources[sid],
+            "page": int(c["page"][i]) or None,
+            "start": int(c["start"][i]),
+            "end": int(c["end"][i]),
+            "token_count": int(c["token_count"][i]),
+            "tags": self._source_tags[sid],
+        }
+
+    def meta(self, chunk_id) -> dict:
+        """Every Chunk field except id and text, without decoding the text."""
+        i = self._row(chunk_id)
+        if i is None:
+            raise KeyError(chunk_id)
+        return self._meta_at(i)
+
+    @property
+    def tags(self) -> set:
+        """Every tag some chunk carries."""
+        return {tag for tags in self._source_tags for tag in tags}
+
+    def ids(self) -> "np.ndarray":
+        """Sorted int64 ids of every chunk."""
+        return np.asarray(self._ids, dtype="int64")
+
+    def ids_where(self, keep) -> "np.ndarray":
+        """Sorted int64 ids of the chunks whose source tags satisfy keep(tags);
+        keep is called once per source, not per chunk."""
+        sids = [sid for sid, tags in enumerate(self._source_tags) if keep(tags)]
+        ids = self.ids()
+        if len(sids) == len(self._sources):
+            return ids
+        return ids[np.isin(np.asarray(self._columns["source"]), sids)]
+
+    def tag_ids(self, tag) -> "np.ndarray":
+        """Sorted int64 ids of the chunks tagged tag (cached per tag)."""
+        ids = self._tag_ids.get(tag)
+        if ids is None:
+            ids = self._tag_ids[tag] = self.ids_where(lambda tags: tag in tags)
+        return ids
+
+    def __getitem__(self, chunk_id) -> Chunk:
+        i = self._row(chunk_id)
+        if i is None:
+            raise KeyError(chunk_id)
+        return Chunk(id=int(self._ids[i]), text=self._text_at(i), **self._meta_at(i))
+
+    def __contains__(self, chunk_id) -> bool:
+        return self._row(chunk_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return (int(i) for i in self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the text buffer, offsets and columns."""
+        def size(a):
+            return a.nbytes if hasattr(a, "nbytes") else a.itemsize * len(a)
+        # Kept vectors and signatures are excluded: they are memory-mapped from disk
+        return len(self._blob) + size(self._offsets) + sum(size(a) for a in self._columns.values())
+
+    @property
+    def source_tags(self) -> dict:
+        """{source filename: its tags}."""
+        return dict(zip(self._sources, self._source_tags))
+
+
+class ChunkStoreBuilder:
+    """Append-only, array-backed accumulator that builds a ChunkStore.
+
+    Rows can be added in any order; build() sorts the columns by id once and
+    leaves the texts where they are, so the blob is never copied. With
+    keep_vectors every add must come with its embedding, and the built store
+    carries them for re-ranking; likewise keep_minhash and signatures.
+    """
+
+    def __init__(self, keep_vectors: bool = False, keep_minhash: bool = False):
+        self._blob = bytearray()
+        self._offsets = array("Q", [0])
+        self._columns = {name: array(code) for name, code, _ in _COLUMNS}
+        self._sources, self._source_ids, self._source_tags = [], {}, []
+        # name -> list of row blocks, or None when that matrix isn't kept
+        self._matrices = {"vectors": [] if keep_vectors else None,
+                          "minhash": [] if keep_minhash else None}
+
+    def _source_id(self, source, tags):
+        sid = self._source_ids.get(source)
+        if sid is None:
+            sid = self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+            self._source_tags.append(tuple(tags))
+        return sid
+
+    def _append_row(self, data: bytes, chunk_id, source, page, start, end, token_count, tags=()):
+        self._blob += data
+        self._offsets.append(len(self._blob))
+        c = self._columns
+        c["id"].append(chunk_id)
+        c["source"].append(self._source_id(source, tags))
+        c["page"].append(page or 0)
+        c["start"].append(start)
+        c["end"].append(end)
+        c["token_count"].append(token_count)
+        c["text"].append(len(self._offsets) - 2)
+
+    def _add_matrix(self, name, values, n):
+        blocks = self._matrices[name]
+        if blocks is None:
+            return
+        if values is None or len(values) != n:
+            raise ValueError(f"this builder keeps {name}: pass one row per chunk")
+        blocks.append(np.asarray(values, dtype=_MATRICES[name][1]))
+
+    def add(self, chunk: Chunk, vector=None, minhash=None) -> None:
+        self._add_matrix("vectors", None if vector is None else np.asarray(vector)[None, :], 1)
+        self._add_matrix("minhash", None if minhash is None else np.asarray(minhash)[None, :], 1)
+        self._append_row(chunk.text.encode("utf-8"), chunk.id, chunk.source, chunk.page,
+                         chunk.start, chunk.end, chunk.token_count, chunk.tags)
+
+    def extend(self, chunks: Iterable[Chunk], vectors=None, minhash=None) -> None:
+        chunks = list(chunks)
+        self._add_matrix("vectors", vectors, len(chunks))
+        self._add_matrix("minhash", minhash, len(chunks))
+        for chunk in chunks:
+            self._append_row(chunk.text.encode("utf-8"), chunk.id, chunk.source, chunk.page,
+                             chunk.start, chunk.end, chunk.token_count, chunk.tags)
+
+    def copy_from(self, store: ChunkStore, exclude=()) -> None:
+        """Append the rows of store, minus ids in exclude, without decoding texts."""
+        if not len(store):
+            return
+        exclude = set(exclude)
+        c, offsets, blob = store._columns, store._offsets, store._blob
+        keep = None
+        for name, blocks in self._matrices.items():
+            if blocks is None:
+                continue
+            source = getattr(store, name)
+            if source is None:
+                raise ValueError(f"source store has no {name} to keep")
+            if keep is None:
+                keep = np.fromiter((int(i) not in exclude for i in c["id"]), dtype=bool, count=len(store))
+            blocks.append(np.asarray(source[keep], dtype=_MATRICES[name][1]))
+        for i in range(len(store)):
+            chunk_id = int(c["id"][i])
+            if chunk_id in exclude:
+                continue
+            sid, j = int(c["source"][i]), int(c["text"][i])
+            self._append_row(
+                blob[int(offsets[j]):int(offsets[j + 1])], chunk_id,
+                store._sources[sid], int(c["page"][i]),
+                int(c["start"][i]), int(c["end"][i]), int(c["token_count"][i]),
+                store._source_tags[sid],
+            )
+
+    def __len__(self) -> int:
+        return len(self._columns["id"])
+
+    def build(self) -> ChunkStore:
+        ids = np.frombuffer(self._columns["id"], dtype="<i8") if len(self) else np.zeros(0, "<i8")
+        matrices = {name: np.concatenate(blocks) if blocks else None
+                    for name, blocks in self._matrices.items() if blocks is not None}
+        columns = self._columns
+        if not np.all(ids[1:] > ids[:-1]):
+            # Only the fixed-width columns move; each row keeps pointing at its text
+            order = np.argsort(ids, kind="stable")
+            columns = {
+                name: array(code, np.frombuffer(columns[name], dtype=dtype)[order].tobytes())
+                for name, code, dtype in _COLUMNS
+            }
+            matrices = {name: None if m is None else m[order] for name, m in matrices.items()}
+        # The store shares the blob: a builder is done once built
+        return ChunkStore(self._blob, self._offsets, columns, self._sources,
+                          source_tags=self._source_tags, **matrices)
+
+
+def build_chunk_store(chunks: Iterable[Chunk], vectors=None, minhash=None) -> ChunkStore:
+    builder = ChunkStoreBuilder(keep_vectors=vectors is not None, keep_minhash=minhash is not None)
+    builder.extend(chunks, vectors, minhash)
+    return builder.build()
+
+
+def write_chunk_store(directory: str, store: ChunkStore) -> int:
+    """Write store in the on-disk layout under directory; returns the count.
+
+    Each file is written to a unique temp name and renamed into place, so
+    processes that still map the previous files keep reading a consistent
+    old copy and concurrent writers never rename each other's files.
+    """
+    if not isinstance(store, ChunkStore):
+        store = build_chunk_store(store)
+    meta = np.zeros(len(store), dtype=[(name, dtype) for name, _, dtype in _COLUMNS])
+    for name, _, dtype in _COLUMNS:
+        meta[name] = np.asarray(store._columns[name], dtype=dtype)
+    offsets = np.asarray(store._offsets, dtype="<u8")
+
+    blob_path, offsets_path, meta_path, sources_path = (os.path.join(directory, f) for f in _FILES)
+    tmp = {}   # final path -> temp path
+    try:
+        with open(tmp.setdefault(blob_path, temp_path_for(blob_path)), "wb") as f:
+            f.write(store._blob)
+        for path, values in ((offsets_path, offsets), (meta_path, meta)):
+            with open(tmp.setdefault(path, temp_path_for(path)), "wb") as f:
+                np.save(f, values)
+        with open(tmp.setdefault(sources_path, temp_path_for(sources_path)), "w", encoding="utf-8") as f:
+            json.dump({"sources": store._sources, "tags": [list(t) for t in store._source_tags]},
+                      f, ensure_ascii=False)
+        for name, (filename, dtype) in _MATRICES.items():
+            if getattr(store, name) is not None:
+                path = os.path.join(directory, filename)
+                with open(tmp.setdefault(path, temp_path_for(path)), "wb") as f:
+                    np.save(f, np.asarray(getattr(store, name), dtype=dtype))
+        for path in list(tmp):
+            os.replace(tmp.pop(path), path)
+    finally:
+        discard(tmp.values())
+    for name, (filename, _) in _MATRICES.items():
+        path = os.path.join(directory, filename)
+        if getattr(store, name) is None and os.path.exists(path):
+            os.remove(path)
+    return len(store)
+
+
+def open_chunk_store(directory: str, use_mmap: bool = True) -> ChunkStore:
+    """Open a store written by write_chunk_store().
+
+    With use_mmap the blob and tables are mapped read-only and shared through
+    the page cache; otherwise they are read into private memory. Raises
+    OSError/ValueError when files are missing or inconsistent.
+    """
+    blob_path, offsets_path, meta_path, sources_path = (os.path.join(directory, f) for f in _FILES)
+    mode = "r" if use_mmap else None
+    offsets = np.load(offsets_path, mmap_mode=mode)
+    meta = np.load(meta_path, mmap_mode=mode)
+    with open(sources_path, "r", encoding="utf-8") as f:
+        sources = json.load(f)
+    sources, source_tags = sources["sources"], sources["tags"]
+    with open(blob_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not use_mmap:
+            blob = f.read()
+        elif size:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            blob = b""   # mmap refuses empty files
+    if len(offsets) != len(meta) + 1 or int(offsets[-1]) != size:
+        raise ValueError(f"chunk store in {directory} is inconsistent")
+    matrices = {}
+    for name, (filename, _) in _MATRICES.items():
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            # Mapped even without use_mmap: keeping them out of RAM is their point
+            matrices[name] = np.load(path, mmap_mode="r")
+            if len(matrices[name]) != len(meta):
+                raise ValueError(f"chunk {name} in {directory} do not match the chunk store")
+    return ChunkStore(blob, offsets, {name: meta[name] for name, _, _ in _COLUMNS}, sources,
+                      source_tags=source_tags, **matrices)
@@ -0,0 +1,221 @@
+"""
+Near-duplicate detection — dedup.py
+
+Roast corpora scraped from many places repeat the same jokes with small edits.
+Every copy costs an embedding, index memory and, worst of all, duplicate
+slots in the top_k context. rag.py runs new chunks through a NearDuplicateFilter
+after chunking and before encoding, and drops a chunk whose estimated Jaccard
+similarity to an already kept chunk reaches the threshold.
+
+Similarity is over sets of word shingles (SHINGLE consecutive casefolded
+words). Each chunk gets a NUM_PERM-value MinHash signature; LSH splits it into
+bands, and only chunks sharing a whole band are compared. Signatures of kept
+chunks are stored with the chunk store (chunks.minhash.npy), so a later
+refresh checks new files against the whole index without rehashing it.
+"""
+
+from __future__ import annotations
+
+import re
+import zlib
+from functools import lru_cache
+
+from utils.lazy_import import lazy_module
+
+np = lazy_module("numpy")
+
+NUM_PERM = 128
+SHINGLE = 3
+_SEED = 1
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+
+@lru_cache(maxsize=None)
+def _permutations(num_perm):
+    # Multiply-shift hashing: h(x) = (a * x + b) mod 2^64 >> 32, a odd
+    rng = np.random.default_rng(_SEED)
+    a = rng.integers(1, 1 << 63, size=num_perm, dtype="uint64") | np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=num_perm, dtype="uint64")
+    return a[:, None], b[:, None]
+
+
+def _false_rates(threshold, bands, rows, steps=50):
+    """Integrated false positive and false negative probability of (bands, rows)."""
+    s = (np.arange(steps) + 0.5) / steps    # midpoint rule over [0, 1]
+    p = 1 - (1 - s ** rows) ** bands
+    fp = np.where(s < threshold, p, 0).sum() / steps
+    fn = np.where(s >= threshold, 1 - p, 0).sum() / steps
+    return fp, fn
+
+
+@lru_cache(maxsize=None)
+def lsh_params(threshold, num_perm=NUM_PERM, fn_weight=3.0):
+    """(bands, rows per band) whose S-curve best separates pairs at threshold.
+
+    Missed duplicates weigh fn_weight times more than spurious candidates:
+    a candidate only costs one signature comparison.
+    """
+    best, best_err = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            fp, fn = _false_rates(threshold, bands, rows)
+            err = fp + fn_weight * fn
+            if err < best_err:
+                best, best_err = (bands, rows), err
+    return best
+
+
+def shingle_hashes(text, width=SHINGLE):
+    """uint32 hashes of the distinct width-word shingles of text (one shingle
+    for texts shorter than width; none for texts without words)."""
+    words = _WORD_RE.findall(text.casefold())
+    if not words:
+        return np.zeros(0, dtype="uint64")
+    h = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype="uint64", count=len(words))
+    width = min(width, len(h))
+    combined = np.zeros(len(h) - width + 1, dtype="uint64")
+    for j in range(width):
+        combined = combined * np.uint64(0x9E3779B1) + h[j:len(h) - width + 1 + j]
+    return np.unique(combined & np.uint64(0xFFFFFFFF))
+
+
+def minhash(text, width=SHINGLE, num_perm=NUM_PERM):
+    """uint32[num_perm] MinHash signature of text's shingle set."""
+    return _minhash(shingle_hashes(text, width), num_perm)
+
+
+def _minhash(shingles, num_perm):
+    if not len(shingles):
+        return np.full(num_perm, 0xFFFFFFFF, dtype="uint32")
+    a, b = _permutations(num_perm)
+    return ((a * shingles + b) >> np.uint64(32)).min(axis=1).astype("uint32")
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.count_nonzero(sig_a == sig_b)) / len(sig_a)
+
+
+def _band_keys(signatures, bands, rows, block=65536):
+    """uint64 key per (signature, band); equal bands give equal keys, and
+    the band number is mixed in, so keys of different bands differ."""
+    sig = np.asarray(signatures).reshape(len(signatures), -1)
+    keys = np.empty((len(sig), bands), dtype="uint64")
+    # In blocks: no uint64 copy of a whole (possibly memory-mapped) matrix
+    for start in range(0, len(sig), block):
+        part = sig[start:start + block, :bands * rows].astype("uint64").reshape(-1, bands, rows)
+        k = np.tile(np.arange(bands, dtype="uint64"), (len(part), 1))
+        for j in range(rows):
+            k = k * np.uint64(0x100000001B3) + part[:, :, j]
+        keys[start:start + len(part)] = k
+    return keys
+
+
+class _Run:
+    """Signatures of a fixed set of chunks plus all their band keys in one
+    sorted array, so the rows sharing any band key with a query are found
+    with two searchsorted calls.
+
+    About 700 bytes per chunk at the defaults (the signature, plus a key and
+    a position per band), instead of Python objects per band.
+    """
+
+    def __init__(self, signatures, ids, bands, rows):
+        keys = _band_keys(signatures, bands, rows).ravel()
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        self.bands = bands
+        self.signatures = signatures
+        self.ids = np.asarray(ids, dtype="int64")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, keys):
+        """Rows sharing at least one band key with keys (may repeat)."""
+        lo = np.searchsorted(self.keys, keys)
+        hi = np.searchsorted(self.keys, keys, side="right")
+        for start, stop in zip(lo[hi > lo].tolist(), hi[hi > lo].tolist()):
+            yield from (self.order[start:stop] // self.bands).tolist()
+
+
+class NearDuplicateFilter:
+    """Streaming first-wins near-duplicate filter.
+
+    Seeded with the signatures of chunks already indexed (seed_signatures,
+    seed_ids), which are searched in place (they may be memory-mapped).
+    Chunks accepted during this run collect in a fixed-size buffer that is
+    scanned directly; full buffers become sorted runs, merged two by two as
+    they pile up, so memory stays array-backed at any corpus size. check()
+    returns (signature, id of the kept chunk it duplicates or None) and
+    remembers the chunk when it is kept. Chunks without any word have no
+    shingles to compare and are never reported as duplicates.
+    """
+
+    _BUFFER = 1024
+
+    def __init__(self, threshold, width=SHINGLE, num_perm=NUM_PERM,
+                 seed_signatures=None, seed_ids=None, ignore_ids=()):
+        self.threshold = threshold
+        self.width = width
+        self.num_perm = num_perm
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self._ignore = set(ignore_ids)
+        self._seed = None
+        if seed_signatures is not None and len(seed_signatures):
+            self._seed = _Run(seed_signatures, seed_ids, self.bands, self.rows)
+        self._runs = []
+        self._buf_keys = np.empty((self._BUFFER, self.bands), dtype="uint64")
+        self._buf_sigs = np.empty((self._BUFFER, num_perm), dtype="uint32")
+        self._buf_ids = np.empty(self._BUFFER, dtype="int64")
+        self._buffered = 0
+        self.checked = self.removed = 0
+
+    def _candidates(self, keys):
+        """(id, signature) of remembered chunks sharing a band with keys."""
+        n = self._buffered
+        for row in np.flatnonzero((self._buf_keys[:n] == keys).any(axis=1)).tolist():
+            yield int(self._buf_ids[row]), self._buf_sigs[row]
+        for run in self._runs:
+            for row in run.candidates(keys):
+                yield int(run.ids[row]), run.signatures[row]
+        if self._seed is not None:
+            for row in self._seed.candidates(keys):
+                chunk_id = int(self._seed.ids[row])
+                if chunk_id not in self._ignore:
+                    yield chunk_id, np.asarray(self._seed.signatures[row])
+
+    def _remember(self, chunk_id, sig, keys):
+        n = self._buffered
+        self._buf_keys[n], self._buf_sigs[n], self._buf_ids[n] = keys, sig, chunk_id
+        self._buffered = n + 1
+        if self._buffered < self._BUFFER:
+            return
+        self._runs.append(_Run(self._buf_sigs.copy(), self._buf_ids.copy(), self.bands, self.rows))
+        self._buffered = 0
+        # Binary-counter merging: O(log n) runs, each row re-sorted O(log n) times
+        while len(self._runs) > 1 and len(self._runs[-2]) <= len(self._runs[-1]):
+            last, prev = self._runs.pop(), self._runs.pop()
+            signatures = np.concatenate([prev.signatures, last.signatures])
+            ids = np.concatenate([prev.ids, last.ids])
+            del last, prev   # free their keys before sorting the merged ones
+            self._runs.append(_Run(signatures, ids, self.bands, self.rows))
+
+    def check(self, chunk_id, text):
+        self.checked += 1
+        shingles = shingle_hashes(text, self.width)
+        sig = _minhash(shingles, self.num_perm)
+        if not len(shingles):
+            # Every such chunk gets the same placeholder signature
+            return sig, None
+        keys = _band_keys(sig[None, :], self.bands, self.rows)[0]
+        seen = set()
+        for other, other_sig in self._candidates(keys):
+            if other not in seen:
+                seen.add(other)
+                if similarity(sig, other_sig) >= self.threshold:
+                    self.removed += 1
+                    return sig, other
+        self._remember(chunk_id, sig, keys)
+        return sig, None
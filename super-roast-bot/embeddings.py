@@ -0,0 +1,115 @@
+"""
+Embedding backends — embeddings.py
+
+rag.py only talks to the Encoder interface below, so the embedding model can
+be swapped through configuration:
+
+  RAG_ENCODER=sentence-transformers[:<model>]   (default, all-MiniLM-L6-v2)
+  RAG_ENCODER=hashing[:<dim>]                   (offline, no download, no torch)
+
+Every encoder has a `name` that identifies it completely (backend, model,
+dimension); rag.py records it in the index manifest so an index is never
+searched with vectors from a different encoder.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import zlib
+
+from utils.lazy_import import lazy_module
+
+np = lazy_module("numpy")
+
+DEFAULT_ENCODER = os.getenv("RAG_ENCODER", "sentence-transformers")
+DEFAULT_ST_MODEL = "all-MiniLM-L6-v2"
+
+
+class Encoder:
+    """Interface: turn a list of texts into a float32 (n, dim) matrix."""
+
+    name: str = "encoder"
+    dim: int = 0
+    # True when encode() ignores letter case, so callers may lowercase inputs freely
+    lowercase: bool = False
+
+    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        raise NotImplementedError
+
+
+class SentenceTransformerEncoder(Encoder):
+    """sentence-transformers model (downloads weights on first use)."""
+
+    def __init__(self, model_name: str = DEFAULT_ST_MODEL):
+        # Imported here: pulls in torch, which takes seconds
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers/{model_name}"
+        # Uncased models (all-MiniLM-L6-v2 among them) lowercase in their tokenizer
+        self.lowercase = bool(getattr(self.model.tokenizer, "do_lower_case", False))
+
+    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        return np.asarray(self.model.encode(list(texts), batch_size=batch_size), dtype="float32")
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class HashingEncoder(Encoder):
+    """Dependency-light encoder: signed feature hashing of words and char n-grams.
+
+    Each word contributes itself plus the 3- and 4-grams of "<word>", so
+    related spellings (segfault / segfaults) still overlap. Features are hashed
+    with crc32 into `dim` buckets with a ±1 sign and the sum is L2-normalized.
+    Deterministic across processes and platforms; starts in milliseconds.
+    """
+
+    VERSION = 1
+    _CACHE_LIMIT = 200_000
+    lowercase = True
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.name = f"hashing-v{self.VERSION}/{dim}"
+        self._word_cache: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    def _word_features(self, word: str) -> tuple[np.ndarray, np.ndarray]:
+        cached = self._word_cache.get(word)
+        if cached is not None:
+            return cached
+        padded = f"<{word}>"
+        grams = [word] + [padded[i:i + n] for n in (3, 4) for i in range(len(padded) - n + 1)]
+        hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint32, count=len(grams))
+        buckets = (hashes % self.dim).astype(np.intp)
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype("float32")
+        signs[0] *= 2.0  # whole-word match counts more than any single n-gram
+        if len(self._word_cache) >= self._CACHE_LIMIT:
+            self._word_cache.clear()
+        self._word_cache[word] = (buckets, signs)
+        return buckets, signs
+
+    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            features = [self._word_features(w) for w in _WORD_RE.findall(text.lower())]
+            if features:
+                buckets = np.concatenate([b for b, _ in features])
+                signs = np.concatenate([s for _, s in features])
+                out[row] = np.bincount(buckets, weights=signs, minlength=self.dim)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+
+def get_encoder(spec: str | None = None) -> Encoder:
+    """Build the encoder named by spec (defaults to RAG_ENCODER)."""
+    spec = (spec or DEFAULT_ENCODER).strip()
+    backend, _, arg = spec.partition(":")
+    backend = backend.lower()
+    if backend in ("sentence-transformers", "sentence_transformers", "minilm"):
+        return SentenceTransformerEncoder(arg or DEFAULT_ST_MODEL)
+    if backend == "hashing":
+        return HashingEncoder(int(arg) if arg else 384)
+    raise ValueError(f"Unknown RAG_ENCODER backend: {spec!r}")
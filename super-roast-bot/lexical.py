@@ -0,0 +1,273 @@
+"""
+Lexical index — lexical.py
+
+Okapi BM25 over the chunk store, for exact keyword hits ("kubernetes",
+"segfault") that a small sentence embedding blurs into generic roasts.
+rag.py fuses its ranking with the FAISS one.
+
+Postings are kept in CSR form: one flat array of document rows per term,
+sorted by term, with an offsets table, instead of a dict of Python lists.
+The BM25 term weight of every posting is precomputed at build time and
+quantized to one byte, so a query is a few array slices, one bincount and an
+argpartition. Per posting this costs 4 (row) + 1 (impact) + 2 (raw tf, kept
+for incremental rebuilds) bytes.
+
+Rows are positions in the id-sorted document table, the same order as the
+chunk store. On disk, next to the chunk store, the arrays are .npy files that
+worker processes memory-map read-only:
+
+  bm25.json           {"k1", "b", "terms"}; a term's id is its list position
+  bm25.offsets.npy    int64[terms + 1]; postings of term t are [offsets[t]:offsets[t + 1]]
+  bm25.rows.npy       int32 document row of each posting
+  bm25.impacts.npy    uint8 quantized BM25 weight of each posting
+  bm25.tfs.npy        uint16 raw term frequency of each posting
+  bm25.docs.npy       one record per document (id, length), sorted by id
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+from array import array
+from collections import Counter
+from typing import Iterable
+
+from utils.atomic_files import discard, temp_path_for
+from utils.lazy_import import lazy_module
+
+np = lazy_module("numpy")
+
+K1 = 1.2
+B = 0.75
+_IMPACT_LEVELS = 255     # impacts are stored as round(weight / (K1 + 1) * 255)
+
+_FILES = ("bm25.json", "bm25.offsets.npy", "bm25.rows.npy", "bm25.impacts.npy",
+          "bm25.tfs.npy", "bm25.docs.npy")
+_DOC_DTYPE = [("id", "<i8"), ("length", "<u4")]
+
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+# Words that match nearly every chunk: scoring them costs the longest postings
+# lists and barely moves a ranking
+STOPWORDS = frozenset("""
+a an and are as at be been but by can do does for from had has have he her his how i if in
+into is it its just me my no not of on or our she so than that the their them then there
+these they this to too up us was we were what when where which who why will with you your
+""".split())
+
+
+def tokenize(text: str) -> list[str]:
+    """Casefolded word tokens of text, minus stopwords and single letters."""
+    return [t for t in _TOKEN_RE.findall(text.casefold())
+            if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+class BM25Index:
+    """Read-only BM25 index; arrays are numpy (possibly memmapped) or empty."""
+
+    def __init__(self, terms: list, offsets, rows, impacts, tfs, docs, k1: float = K1, b: float = B):
+        self._terms = terms
+        self._vocab = {t: i for i, t in enumerate(terms)}
+        self._offsets = offsets
+        self._rows = rows
+        self._impacts = impacts
+        self._tfs = tfs
+        self._docs = docs
+        self.ids = docs["id"]
+        self.k1, self.b = k1, b
+
+    @classmethod
+    def empty(cls) -> "BM25Index":
+        return BM25Builder().build()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self._terms)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the postings and document arrays (vocabulary excluded)."""
+        return sum(a.nbytes for a in (self._offsets, self._rows, self._impacts, self._tfs, self._docs))
+
+    def _idf(self, df):
+        n = len(self._docs)
+        return np.log1p((n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int, allow=None, exclude=None):
+        """(scores, chunk ids) of the k best BM25 matches, best first.
+
+        Documents sharing no term with the query are never returned, so fewer
+        than k results (possibly none) come back for rare words. allow and
+        exclude (sorted id arrays) restrict the matches before the top k are
+        taken.
+        """
+        term_ids = sorted({self._vocab[t] for t in tokenize(query) if t in self._vocab})
+        if not term_ids or k <= 0:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        term_ids = np.asarray(term_ids)
+        starts, ends = self._offsets[term_ids], self._offsets[term_ids + 1]
+        df = ends - starts
+        idf = (self._idf(df.astype("float64")) * ((self.k1 + 1) / _IMPACT_LEVELS)).astype("float32")
+        rows = np.concatenate([self._rows[s:e] for s, e in zip(starts, ends)])
+        impacts = np.concatenate([self._impacts[s:e] for s, e in zip(starts, ends)])
+        weights = impacts * np.repeat(idf, df)
+        if len(term_ids) == 1:
+            hit_rows, scores = rows, weights
+        elif len(rows) * 8 < len(self._docs):
+            # Few postings: sum per distinct row instead of over every document
+            hit_rows, inverse = np.unique(rows, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights)
+        else:
+            scores = np.bincount(rows, weights=weights, minlength=len(self._docs))
+            hit_rows = np.flatnonzero(scores)
+            scores = scores[hit_rows]
+        if allow is not None or exclude is not None:
+            hit_ids = self.ids[hit_rows]
+            keep = np.ones(len(hit_rows), dtype=bool)
+            if allow is not None:
+                keep &= np.isin(hit_ids, allow)
+            if exclude is not None:
+                keep &= ~np.isin(hit_ids, exclude)
+            hit_rows, scores = hit_rows[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            hit_rows, scores = hit_rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return scores[order].astype("float32"), np.asarray(self.ids[hit_rows[order]], dtype="int64")
+
+
+class BM25Builder:
+    """Accumulates documents (and the surviving rows of an existing index)
+    and builds a BM25Index; mirrors chunk_store.ChunkStoreBuilder."""
+
+    def __init__(self, k1: float = K1, b: float = B):
+        self.k1, self.b = k1, b
+        self._terms, self._vocab = [], {}
+        self._doc_ids, self._doc_lens = array("q"), array("I")
+        self._post_terms, self._post_ids, self._post_tfs = array("I"), array("q"), array("H")
+        self._blocks = []    # (doc ids, doc lengths, posting terms, posting ids, tfs) copied in bulk
+
+    def _term_id(self, term):
+        tid = self._vocab.get(term)
+        if tid is None:
+            tid = self._vocab[term] = len(self._terms)
+            self._terms.append(term)
+        return tid
+
+    def add(self, chunk_id: int, text: str) -> None:
+        tokens = tokenize(text)
+        self._doc_ids.append(chunk_id)
+        self._doc_lens.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            self._post_terms.append(self._term_id(term))
+            self._post_ids.append(chunk_id)
+            self._post_tfs.append(min(tf, 0xFFFF))
+
+    def extend(self, chunks: Iterable) -> None:
+        """Add Chunk-like objects (anything with .id and .text)."""
+        for chunk in chunks:
+            self.add(chunk.id, chunk.text)
+
+    def copy_from(self, index: BM25Index, exclude=()) -> None:
+        """Append the documents of index, minus ids in exclude, without re-tokenizing."""
+        if not len(index):
+            return
+        exclude = np.fromiter(exclude, dtype="int64")
+        keep_docs = ~np.isin(index.ids, exclude)
+        term_map = np.fromiter((self._term_id(t) for t in index._terms), dtype="uint32",
+                               count=len(index._terms))
+        post_terms = np.repeat(term_map, np.diff(index._offsets))
+        post_ids = np.asarray(index.ids)[index._rows]
+        keep = ~np.isin(post_ids, exclude)
+        self._blocks.append((
+            np.asarray(index.ids[keep_docs], dtype="int64"),
+            np.asarray(index._docs["length"][keep_docs], dtype="uint32"),
+            post_terms[keep], post_ids[keep], np.asarray(index._tfs)[keep],
+        ))
+
+    def __len__(self) -> int:
+        return len(self._doc_ids) + sum(len(block[0]) for block in self._blocks)
+
+    def build(self) -> BM25Index:
+        def gather(i, own, dtype):
+            parts = [block[i] for block in self._blocks] + [np.frombuffer(own, dtype=dtype)]
+            return np.concatenate(parts) if len(parts) > 1 else parts[0].copy()
+
+        doc_ids = gather(0, self._doc_ids, "<i8")
+        doc_lens = gather(1, self._doc_lens, "<u4")
+        post_terms = gather(2, self._post_terms, "<u4")
+        post_ids = gather(3, self._post_ids, "<i8")
+        tfs = gather(4, self._post_tfs, "<u2")
+
+        order = np.argsort(doc_ids, kind="stable")
+        docs = np.zeros(len(doc_ids), dtype=_DOC_DTYPE)
+        docs["id"], docs["length"] = doc_ids[order], doc_lens[order]
+        rows = np.searchsorted(docs["id"], post_ids).astype("int32")
+
+        # Drop terms left without postings (their documents were excluded)
+        df = np.bincount(post_terms, minlength=len(self._terms))
+        live = np.flatnonzero(df)
+        remap = np.zeros(len(self._terms), dtype="uint32")
+        remap[live] = np.arange(len(live), dtype="uint32")
+        post_terms = remap[post_terms]
+        terms = [self._terms[i] for i in live.tolist()]
+
+        order = np.lexsort((rows, post_terms))
+        rows, tfs, post_terms = rows[order], tfs[order], post_terms[order]
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(np.bincount(post_terms, minlength=len(terms)), out=offsets[1:])
+
+        lengths = docs["length"].astype("float32")
+        avgdl = float(lengths.mean()) if len(lengths) and lengths.any() else 1.0
+        norm = self.k1 * (1 - self.b + self.b * lengths / avgdl)
+        tf = tfs.astype("float32")
+        weight = tf * (self.k1 + 1) / (tf + norm[rows])
+        impacts = np.clip(np.rint(weight * (_IMPACT_LEVELS / (self.k1 + 1))), 1, _IMPACT_LEVELS).astype("uint8")
+        return BM25Index(terms, offsets, rows, impacts, tfs, docs, self.k1, self.b)
+
+
+def build_bm25(chunks: Iterable) -> BM25Index:
+    builder = BM25Builder()
+    builder.extend(chunks)
+    return builder.build()
+
+
+def write_bm25(directory: str, index: BM25Index) -> int:
+    """Write index next to the chunk store; returns the document count.
+
+    Same temp-file-and-rename scheme as write_chunk_store(), so mapped readers
+    of the previous files keep a consistent view.
+    """
+    meta_path, *array_paths = (os.path.join(directory, f) for f in _FILES)
+    arrays = (index._offsets, index._rows, index._impacts, index._tfs, index._docs)
+    tmp = {}   # final path -> temp path
+    try:
+        for path, values in zip(array_paths, arrays):
+            with open(tmp.setdefault(path, temp_path_for(path)), "wb") as f:
+                np.save(f, np.asarray(values))
+        with open(tmp.setdefault(meta_path, temp_path_for(meta_path)), "w", encoding="utf-8") as f:
+            json.dump({"k1": index.k1, "b": index.b, "terms": index._terms}, f, ensure_ascii=False)
+        for path in list(tmp):
+            os.replace(tmp.pop(path), path)
+    finally:
+        discard(tmp.values())
+    return len(index)
+
+
+def open_bm25(directory: str, use_mmap: bool = True) -> BM25Index:
+    """Open an index written by write_bm25(); the arrays are mapped read-only
+    with use_mmap. Raises OSError/ValueError when files are missing or
+    inconsistent."""
+    meta_path, *array_paths = (os.path.join(directory, f) for f in _FILES)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    mode = "r" if use_mmap else None
+    offsets, rows, impacts, tfs, docs = (np.load(p, mmap_mode=mode) for p in array_paths)
+    if (len(offsets) != len(meta["terms"]) + 1 or int(offsets[-1]) != len(rows)
+            or not len(rows) == len(impacts) == len(tfs)):
+        raise ValueError(f"BM25 index in {directory} is inconsistent")
+    return BM25Index(meta["terms"], offsets, rows, impacts, tfs, docs, meta["k1"], meta["b"])
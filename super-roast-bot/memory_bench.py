@@ -0,0 +1,179 @@
+"""
+Worker memory benchmark — memory_bench.py
+
+Shows what memory-mapping the RAG cache saves when several worker processes
+(uvicorn --workers N, several Streamlit servers) run on one host. For each
+worker count it starts N processes that all load the same cache and serve a
+few queries, then samples every worker's /proc/<pid>/smaps_rollup while all
+of them are alive:
+
+  RSS  resident pages, shared ones counted in full in every worker
+  PSS  shared pages divided among the processes mapping them; the sum over
+       workers is the real host memory
+  USS  pages private to the worker (what killing it would free)
+
+"private" loads the index and chunks into each worker (RAG_MMAP=0);
+"mmap" maps the files read-only (RAG_MMAP=1) so the page cache holds one copy.
+The corpus is synthetic and embedded with the HashingEncoder, so this runs
+offline. Linux only (needs smaps_rollup).
+
+Usage:
+  python memory_bench.py
+  python memory_bench.py --chunks 300000 --workers 1 4 16 --index hnsw
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WORKERS = (1, 4, 16)
+MODES = (("private", "0"), ("mmap", "1"))
+
+_WORKER = r"""
+import json, sys
+import rag
+rag.warmup()
+for q in ("segfault in production", "merge conflict", "legacy spaghetti code"):
+    rag.retrieve_context(q, top_k=3)
+print("ready", flush=True)
+sys.stdin.readline()
+stats = {}
+with open("/proc/self/smaps_rollup") as f:
+    for line in f:
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == "kB":
+            stats[parts[0].rstrip(":")] = int(parts[1]) * 1024
+print(json.dumps(stats), flush=True)
+sys.stdin.readline()
+"""
+
+
+def _env(data_dir, cache_dir, mmap_flag, index):
+    return {
+        **os.environ,
+        "PYTHONPATH": HERE + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "RAG_DATA_DIR": data_dir,
+        "RAG_CACHE_DIR": cache_dir,
+        "RAG_ENCODER": "hashing",
+        "RAG_INDEX_FACTORY": index,
+        "RAG_CHUNK_SIZE": "32",   # about one synthetic record per chunk
+        "RAG_MMAP": mmap_flag,
+        "RAG_PROGRESS_INTERVAL": "0",
+        "RAG_QUERY_BATCHING": "0",
+    }
+
+
+def write_corpus(data_dir: str, n: int, seed: int = 0) -> None:
+    from rag_bench import generate_corpus
+
+    with open(os.path.join(data_dir, "corpus.txt"), "w", encoding="utf-8") as f:
+        for start in range(0, n, 50_000):
+            f.write("\n\n".join(generate_corpus(min(50_000, n - start), seed=seed + start)) + "\n\n")
+
+
+def measure_workers(n: int, env: dict) -> list[dict]:
+    """smaps_rollup of n concurrently alive workers."""
+    procs = [
+        subprocess.Popen([sys.executable, "-W", "ignore", "-c", _WORKER], cwd=HERE, env=env,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in range(n)
+    ]
+    try:
+        for p in procs:
+            if p.stdout.readline().strip() != "ready":
+                raise RuntimeError("worker failed to load the RAG cache")
+        samples = []
+        for p in procs:
+            p.stdin.write("measure\n")
+            p.stdin.flush()
+            samples.append(json.loads(p.stdout.readline()))
+        return samples
+    finally:
+        for p in procs:
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+        for p in procs:
+            p.wait(timeout=60)
+
+
+def _summarize(samples: list[dict]) -> dict:
+    n = len(samples)
+    uss = [s.get("Private_Clean", 0) + s.get("Private_Dirty", 0) for s in samples]
+    return {
+        "workers": n,
+        "rss_per_worker": sum(s["Rss"] for s in samples) / n,
+        "pss_per_worker": sum(s["Pss"] for s in samples) / n,
+        "uss_per_worker": sum(uss) / n,
+        "pss_total": sum(s["Pss"] for s in samples),
+    }
+
+
+def run(chunks: int, workers=DEFAULT_WORKERS, index: str = "flat") -> dict:
+    with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as cache_dir:
+        t0 = time.perf_counter()
+        write_corpus(data_dir, chunks)
+        build = subprocess.run([sys.executable, "-W", "ignore", os.path.join(HERE, "rag.py")],
+                               cwd=HERE, env=_env(data_dir, cache_dir, "1", index),
+                               capture_output=True, text=True)
+        if build.returncode != 0:
+            raise RuntimeError(build.stderr[-2000:])
+        print(f"[memory] {build.stdout.strip().splitlines()[-1]} (incl. corpus generation "
+              f"{time.perf_counter() - t0:.1f}s)")
+        cache_bytes = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)
+                          if os.path.isfile(os.path.join(cache_dir, f)))
+
+        rows = []
+        for n in workers:
+            for mode, flag in MODES:
+                row = {"mode": mode, **_summarize(measure_workers(n, _env(data_dir, cache_dir, flag, index)))}
+                print(f"[memory] {n:>3} workers, {mode:<7}: PSS/worker {row['pss_per_worker'] / 2**20:8.1f} MB, "
+                      f"host total {row['pss_total'] / 2**20:8.1f} MB")
+                rows.append(row)
+    return {"chunks_requested": chunks, "index": index, "cache_bytes": cache_bytes, "rows": rows}
+
+
+def format_table(result: dict) -> str:
+    header = (f"{'workers':>7}  {'mode':<8} {'RSS/worker MB':>13} {'PSS/worker MB':>13} "
+              f"{'USS/worker MB':>13} {'host PSS MB':>11}")
+    lines = [f"cache on disk: {result['cache_bytes'] / 2**20:.1f} MB ({result['index']} index)",
+             header, "-" * len(header)]
+    for r in result["rows"]:
+        lines.append(
+            f"{r['workers']:>7}  {r['mode']:<8} {r['rss_per_worker'] / 2**20:>13.1f} "
+            f"{r['pss_per_worker'] / 2**20:>13.1f} {r['uss_per_worker'] / 2**20:>13.1f} "
+            f"{r['pss_total'] / 2**20:>11.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Per-worker memory with and without a mapped RAG cache.")
+    parser.add_argument("--chunks", type=int, default=100_000, help="Synthetic records to index")
+    parser.add_argument("--workers", type=int, nargs="+", default=list(DEFAULT_WORKERS))
+    parser.add_argument("--index", default="flat",
+                        help="RAG_INDEX_FACTORY value; IVF inverted lists cannot be mapped")
+    parser.add_argument("--out", help="Write <out>.json with the raw numbers")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        print("memory_bench.py needs Linux /proc/<pid>/smaps_rollup")
+        return 1
+    result = run(args.chunks, args.workers, args.index)
+    print("\n" + format_table(result))
+    if args.out:
+        with open(args.out + ".json", "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,70 +1,2122 @@
 import os
-import faiss
-import numpy as np
+import json
+import time
+import hashlib
+import itertools
+import multiprocessing
+import re
+import queue
 import threading
-from sentence_transformers import SentenceTransformer
-from PyPDF2 import PdfReader 
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import reduce
+from dataclasses import dataclass, field
+from typing import Optional
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from chunk_store import Chunk, ChunkStore, ChunkStoreBuilder, open_chunk_store, write_chunk_store
+from dedup import NUM_PERM, NearDuplicateFilter
+from embeddings import get_encoder
+from lexical import BM25Builder, BM25Index, open_bm25, write_bm25
+from utils.atomic_files import discard, temp_path_for
+from utils.lazy_import import lazy_module
+from utils.roast_mode import ROAST_MODES
+from utils.token_guard import count_tokens, tokenizer_name
+
+try:
+    import fcntl
+except ImportError:   # Windows: no cross-process cache lock
+    fcntl = None
+
+# Only needed once the index is built or searched; importing rag (and api.py)
+# stays cheap until then
+faiss = lazy_module("faiss")
+np = lazy_module("numpy")
+
+DATA_FOLDER = os.getenv("RAG_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+CACHE_DIR = os.getenv("RAG_CACHE_DIR", os.path.join(os.path.dirname(__file__), "rag_cache"))
+
+# Chunks are packed from whole records/lines/sentences up to CHUNK_SIZE,
+# measured in CHUNK_UNIT ("tokens" via utils.token_guard, or "chars")
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", 128))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", 0))
+CHUNK_UNIT = os.getenv("RAG_CHUNK_UNIT", "tokens")
+SUPPORTED_EXTENSIONS = (".txt", ".pdf")
+
+# Chunks are tagged with the tags of their file: its directory names under
+# DATA_FOLDER, the words of its file name, and the "tags:"/"mode:"/"topic:"
+# lines of a leading "---" front-matter block in text files, e.g.
+#   data/professional/office_jokes.txt  ->  professional, office, jokes
+# search(..., mode="Professional 💼") keeps chunks tagged "professional" plus
+# those tagged with no roast mode at all; search(..., tags=[...]) keeps
+# chunks carrying any of the tags. Both filters run inside the FAISS search.
+_FRONT_MATTER_RE = re.compile(r"\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)", re.S)
+_FRONT_MATTER_KEYS = frozenset(("tags", "tag", "mode", "modes", "topic", "topics"))
+
+# FAISS index: a factory string ("Flat", "IVF1024,Flat", "IVF1024,PQ48",
+# "HNSW32", "SQ8"), a shorthand without sizes ("flat", "ivf-flat", "ivf-pq",
+# "hnsw", and the compressed "sq-fp16", "sq8", "pq", "ivf-sq8") or "auto" to
+# pick by corpus size. The resolved string is recorded in the cache manifest
+# so reloads use the same index.
+INDEX_FACTORY = os.getenv("RAG_INDEX_FACTORY", "auto")
+AUTO_IVF_MIN_VECTORS = 20_000
+AUTO_PQ_MIN_VECTORS = 1_000_000
+NPROBE = int(os.getenv("RAG_NPROBE", 16))
+EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", 64))
+
+# Exact re-ranking for compressed indexes: fetch top_k * RERANK_FACTOR
+# candidates, then re-score them against full-precision vectors kept on disk
+# next to the chunk store (memory-mapped, so they cost page cache, not RAM).
+# 0 disables it and stops keeping the vectors.
+RERANK_FACTOR = int(os.getenv("RAG_RERANK", 0))
+
+# Hybrid retrieval: the dense ranking is fused with a BM25 ranking over the
+# same chunks (lexical.py), so exact keywords ("kubernetes", "segfault") win
+# without raising top_k. "rrf" = reciprocal-rank fusion (constant RRF_K),
+# "weighted" = HYBRID_WEIGHT * dense + (1 - HYBRID_WEIGHT) * BM25 on
+# normalized scores, "off" = dense only. Each side contributes its best
+# top_k * HYBRID_DEPTH candidates. The BM25 index is always built.
+HYBRID = os.getenv("RAG_HYBRID", "rrf").lower()
+HYBRID_WEIGHT = float(os.getenv("RAG_HYBRID_WEIGHT", 0.5))
+HYBRID_DEPTH = int(os.getenv("RAG_HYBRID_DEPTH", 4))
+RRF_K = int(os.getenv("RAG_RRF_K", 60))
+
+# Result shaping, applied to the ranking retrieval produced and its scores:
+# cosine similarity to the query with HYBRID=off, else the fused score scaled
+# to 0..1 (1 = top of both rankings), so BM25-only keyword hits keep their
+# fused rank. MMR_LAMBDA < 1 over-fetches top_k * MMR_FETCH candidates and
+# picks top_k by Maximal Marginal Relevance: lambda * score minus
+# (1 - lambda) * cosine similarity to the closest chunk already picked
+# (1 = off). MIN_SCORE drops candidates scoring below it; SCORE_GAP cuts the
+# ranking at the first drop between neighbours larger than it (0 = off), so
+# a weak tail never reaches the prompt.
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", 1))
+MMR_FETCH = int(os.getenv("RAG_MMR_FETCH", 4))
+MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", 0))
+SCORE_GAP = float(os.getenv("RAG_SCORE_GAP", 0))
+
+# Tokens the "\n\n" between two packed chunks costs (cl100k_base: one)
+_SEPARATOR_TOKENS = 1
+
+# Open the cached index and chunk store memory-mapped and read-only, so every
+# worker process on the host shares one copy through the page cache
+MMAP_CACHE = os.getenv("RAG_MMAP", "1") != "0"
+
+# Near-duplicate removal at ingest (dedup.py): a new chunk whose estimated
+# Jaccard similarity (DEDUP_SHINGLE-word shingles, MinHash + LSH) to an
+# already kept chunk reaches DEDUP_THRESHOLD is dropped before it is embedded.
+# The first copy in file-name order wins. 0 disables it.
+DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", 0.8))
+DEDUP_SHINGLE = int(os.getenv("RAG_DEDUP_SHINGLE", 3))
+
+# Streaming ingestion: chunks are encoded and added to the index in batches of
+# EMBED_BATCH_SIZE, so peak memory is independent of corpus size
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", 256))
+TEXT_BLOCK_CHARS = 1 << 16
+PROGRESS_INTERVAL = float(os.getenv("RAG_PROGRESS_INTERVAL", 5))
+
+# PDF text extraction runs in a process pool (pure-Python, CPU-bound)
+PDF_WORKERS = int(os.getenv("RAG_PDF_WORKERS", os.cpu_count() or 1))
+
+# Concurrent query encodes are coalesced into one model call of up to
+# QUERY_BATCH_SIZE queries, waiting at most QUERY_BATCH_WAIT_MS for stragglers.
+# QUERY_BATCHING=0 falls back to encoding each query on the calling thread.
+QUERY_BATCHING = os.getenv("RAG_QUERY_BATCHING", "1") != "0"
+QUERY_BATCH_SIZE = int(os.getenv("RAG_QUERY_BATCH_SIZE", 64))
+QUERY_BATCH_WAIT_MS = float(os.getenv("RAG_QUERY_BATCH_WAIT_MS", 2))
+
+# The encoder only reads the start of a long input (MiniLM: 256 word pieces),
+# so queries longer than QUERY_SEGMENT_TOKENS are split into segments on
+# sentence/word boundaries. The segments are encoded in one batch and
+# searched as one multi-row search; a chunk keeps its best score over the
+# segments. 0 = never split.
+QUERY_SEGMENT_TOKENS = int(os.getenv("RAG_QUERY_SEGMENT_TOKENS", 200))
+
+# In-process retrieval caches (entries; TTL in seconds, 0 = no expiry)
+EMBED_CACHE_SIZE = int(os.getenv("RAG_EMBED_CACHE_SIZE", 1024))
+RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", 1024))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RAG_RETRIEVAL_CACHE_TTL", 3600))
+
+# Anti-repetition: retrieve_context(..., session_id=...) skips the last
+# RECENT_CHUNKS chunks it served to that session (0 = off). The exclusion is
+# applied inside the FAISS search through an ID selector, or by over-fetching
+# and filtering for index types without selector support. At most
+# ntotal - top_k ids are excluded, so a small corpus rotates instead of
+# running dry. RECENT_SESSIONS bounds the sessions tracked (least recently
+# active dropped first, idle ones after RETRIEVAL_CACHE_TTL).
+RECENT_CHUNKS = int(os.getenv("RAG_RECENT_CHUNKS", 30))
+RECENT_SESSIONS = int(os.getenv("RAG_RECENT_SESSIONS", 1024))
+
+# Requests that arrive while a background warmup() is still loading either
+# "wait" up to READY_TIMEOUT seconds or "skip" straight to an empty context
+NOT_READY_POLICY = os.getenv("RAG_NOT_READY_POLICY", "wait")
+READY_TIMEOUT = float(os.getenv("RAG_READY_TIMEOUT", 10))
+# A failed background warmup is retried after WARMUP_RETRY seconds, doubling
+# up to WARMUP_RETRY_MAX between attempts (0 = give up after one failure)
+WARMUP_RETRY = float(os.getenv("RAG_WARMUP_RETRY", 5))
+WARMUP_RETRY_MAX = float(os.getenv("RAG_WARMUP_RETRY_MAX", 300))
+
+# Bump when the on-disk cache layout changes so stale caches are rebuilt
+CACHE_FORMAT_VERSION = 9
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """Everything a search needs, published as one immutable unit.
+
+    Readers grab `_current` once and use only that object, so a rebuild that
+    swaps in a new snapshot never changes an in-flight search underneath it.
+    """
+    index: object
+    chunks: ChunkStore  # read-only {chunk id: Chunk}, texts decoded on access
+    lexical: object   # BM25Index over the same chunks
+    ledger: dict
+    manifest: dict    # manifest of the index, incl. resolved index_factory
+    version: int      # bumped on every publish; part of the result-cache key
+    published_at: float
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    """One retrieved chunk, as returned by search().
+
+    score is the cosine similarity between query and chunk embedding with
+    RAG_HYBRID=off, else the fused dense + BM25 score scaled to 0..1 (higher
+    is better either way). text is decoded from the searched snapshot's chunk store on
+    access, so records stay valid after a rebuild and cost nothing until a
+    caller actually formats them.
+    """
+    chunk_id: int
+    score: float
+    source: str
+    page: Optional[int]
+    token_count: int
+    tags: tuple
+    _chunks: object = field(repr=False, compare=False)
+
+    @property
+    def text(self) -> str:
+        return self._chunks.text(self.chunk_id)
 
-DATA_FOLDER = os.path.join(os.path.dirname(__file__), "data")
 
 # Thread-safe singleton for RAG components
 _rag_lock = threading.Lock()
+# Every model call goes through _embed() under this lock: the encoder is shared
+# by query encodes and background rebuilds, and HF fast tokenizers fail when
+# used from two threads at once ("Already borrowed")
+_encoder_lock = threading.Lock()
+_refresh_lock = threading.Lock()   # one rebuild/refresh at a time
 _rag_initialized = False
-_global_chunks = None
-_global_index = None
-_global_model = None
+_current = None   # the live _Snapshot; replaced wholesale, never mutated
+_global_encoder = None
+_global_batcher = None
+_rebuild_status = {"state": "idle"}
 
-def get_text_from_files():
-    all_text = ""
+# Readiness state machine: cold -> loading -> ready | failed
+_rag_state = "cold"
+_rag_error = None
+_warmup_seconds = None
+_ready_event = threading.Event()
+_warmup_thread = None
+_warmup_retry_at = None   # time.monotonic() of the next background attempt
+_warmup_lock = threading.Lock()   # never held across initialization
+
+def _iter_file_pages(file_path):
+    """Yield (page, text) pieces of one .txt/.pdf file.
+
+    PDFs yield one piece per page (1-based page numbers); text files are read
+    in blocks of TEXT_BLOCK_CHARS with page None, so a huge file is never held
+    in memory at once.
+    """
+    if file_path.endswith(".txt"):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for block in iter(lambda: f.read(TEXT_BLOCK_CHARS), ""):
+                yield None, block
+        return
+    yield from enumerate(_extract_pdf_pages(file_path)[0], start=1)
+
+def _extract_pdf_pages(file_path):
+    """Return (page texts, seconds). Top-level so it can run in a worker process.
+
+    Pages without extractable text are kept as "" so page numbers stay true.
+    """
+    from PyPDF2 import PdfReader  # deferred: only needed when PDFs are (re)ingested
+
+    t0 = time.perf_counter()
+    pages = []
+    try:
+        reader = PdfReader(file_path)
+        for page in reader.pages:
+            content = page.extract_text()
+            pages.append(str(content).strip() + "\n" if content else "") # SAFETY FIX FOR NONE-TYPE
+    except Exception as e:
+        print(f"Error reading {os.path.basename(file_path)}: {e}")
+    return pages, time.perf_counter() - t0
+
+def _read_file_text(file_path):
+    """Return the text of one .txt/.pdf file ("" for unreadable PDFs)."""
+    return "".join(text for _, text in _iter_file_pages(file_path))
+
+def _list_data_files():
+    """Data files as "/"-separated paths relative to DATA_FOLDER, subdirectories included."""
     if not os.path.exists(DATA_FOLDER):
         os.makedirs(DATA_FOLDER)
-        return ""
-    for filename in os.listdir(DATA_FOLDER):
-        file_path = os.path.join(DATA_FOLDER, filename)
-        if filename.endswith(".txt"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                all_text += f.read() + "\n"
-        elif filename.endswith(".pdf"):
+        return []
+    files = []
+    for root, dirs, names in os.walk(DATA_FOLDER):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        rel = os.path.relpath(root, DATA_FOLDER)
+        for name in names:
+            if name.endswith(SUPPORTED_EXTENSIONS):
+                files.append(name if rel == "." else os.path.join(rel, name).replace(os.sep, "/"))
+    return sorted(files)
+
+def get_text_from_files():
+    return "".join(_read_file_text(os.path.join(DATA_FOLDER, f)) for f in _list_data_files())
+
+# ---------------- Tagging ---------------- #
+
+def normalize_tag(tag):
+    """Casefolded words of tag joined by "-" ("Professional 💼" -> "professional")."""
+    return "-".join(re.findall(r"[^\W_]+", tag.casefold()))
+
+MODE_TAGS = frozenset(normalize_tag(mode) for mode in ROAST_MODES)
+
+def _path_tags(filename):
+    *dirs, name = filename.split("/")
+    return [normalize_tag(d) for d in dirs] + re.findall(r"[^\W_]+", os.path.splitext(name)[0].casefold())
+
+def _front_matter(text):
+    """(tags, length) of a leading front-matter block; ([], 0) without one.
+    Values are comma separated ("tags: office, dry humor")."""
+    m = _FRONT_MATTER_RE.match(text)
+    if not m:
+        return [], 0
+    tags = []
+    for line in m.group(1).splitlines():
+        key, sep, value = line.partition(":")
+        if sep and key.strip().casefold() in _FRONT_MATTER_KEYS:
+            tags.extend(normalize_tag(v) for v in value.strip(" []").split(","))
+    return tags, m.end()
+
+# ---------------- Chunking ---------------- #
+
+# Split levels, coarsest first: records (blank-line separated), lines,
+# sentences, words. A unit is only split further when it alone is too big.
+_SPLIT_LEVELS = (
+    re.compile(r"\n[ \t]*\n\s*"),
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.!?])\s+"),
+    re.compile(r"\s+"),
+)
+
+
+def _measure(text, unit):
+    return count_tokens(text) if unit == "tokens" else len(text)
+
+
+def _trimmed_span(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return (start, end) if start < end else None
+
+
+def _split_units(text, start, end, max_size, unit, level=0):
+    """Return [(start, end, size)] units of text[start:end], each <= max_size."""
+    spans, pos = [], start
+    for m in _SPLIT_LEVELS[level].finditer(text, start, end):
+        spans.append(_trimmed_span(text, pos, m.start()))
+        pos = m.end()
+    spans.append(_trimmed_span(text, pos, end))
+
+    units = []
+    for span in filter(None, spans):
+        s, e = span
+        size = _measure(text[s:e], unit)
+        if size <= max_size:
+            units.append((s, e, size))
+        elif level + 1 < len(_SPLIT_LEVELS):
+            units.extend(_split_units(text, s, e, max_size, unit, level + 1))
+        else:
+            # A single "word" over the limit (base64, URLs…): hard cut. A token
+            # is never shorter than one char, so max_size chars always fits.
+            for i in range(s, e, max_size):
+                piece = text[i:min(i + max_size, e)]
+                units.append((i, i + len(piece), _measure(piece, unit)))
+    return units
+
+
+def _separators(text, unit):
+    """gap(a, b): size of the text between units a and b, which a chunk
+    holding both carries along. Exact in chars; in tokens a chunk is sized
+    as the sum of its parts' counts, separators included."""
+    if unit == "chars":
+        return lambda a, b: b[0] - a[1]
+    return lambda a, b: _measure(text[a[1]:b[0]], unit) if b[0] > a[1] else 0
+
+
+def _pack_units(units, max_size, overlap, gap=None):
+    """Greedily pack consecutive units into (start, end) chunk spans.
+
+    A chunk's size counts its units plus the separators between them
+    (gap(a, b), see _separators()), so max_size bounds the chunk text. The
+    trailing units of a chunk (up to `overlap` in size) are repeated at the
+    start of the next one. units may be any iterable; it is read lazily.
+    """
+    gap = gap or (lambda a, b: 0)
+    current, size = [], 0
+    for u in units:
+        if current and size + gap(current[-1], u) + u[2] > max_size:
+            yield current[0][0], current[-1][1]
+            tail, tail_size = [], 0
+            for prev in reversed(current[1:]):
+                cost = prev[2] + (gap(prev, tail[0]) if tail else 0)
+                if tail_size + cost > overlap:
+                    break
+                tail.insert(0, prev)
+                tail_size += cost
+            while tail and tail_size + gap(tail[-1], u) + u[2] > max_size:
+                first = tail.pop(0)
+                tail_size -= first[2] + (gap(first, tail[0]) if tail else 0)
+            current, size = tail, tail_size
+        size += (gap(current[-1], u) if current else 0) + u[2]
+        current.append(u)
+    if current:
+        yield current[0][0], current[-1][1]
+
+
+def _chunk_id(source, page, start, text):
+    """Stable 63-bit id: same file, position and text give the same id on every build."""
+    key = f"{source}\0{page}\0{start}\0{text}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big") >> 1
+
+
+def _chunk_sections(source, page, sections, chunk_size=None, overlap=None, unit=None, tags=()):
+    """Chunk consecutive (start offset, text) sections as one text.
+
+    Sections are split into units one by one and packed by a single packer,
+    so overlap carries across section ends. Only the text from the start of
+    the last chunk on is kept. Sections must end on unit boundaries (records,
+    see _record_sections()) for the chunks to match chunking the whole text.
+    """
+    chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+    overlap = CHUNK_OVERLAP if overlap is None else overlap
+    unit = CHUNK_UNIT if unit is None else unit
+    text, base, keep = "", None, None   # text[0] is at offset base
+
+    def units():
+        nonlocal text, base
+        for start, section in sections:
+            if base is None:
+                base = start
+            elif keep is not None:
+                text, base = text[keep - base:], keep
+            text += section
+            for s, e, size in _split_units(section, 0, len(section), chunk_size, unit):
+                yield start + s, start + e, size
+
+    def gap(a, b):
+        if unit == "chars" or b[0] <= a[1]:
+            return b[0] - a[1]
+        return _measure(text[a[1] - base:b[0] - base], unit)
+
+    for s, e in _pack_units(units(), chunk_size, overlap, gap):
+        body = text[s - base:e - base]
+        keep = s   # the next chunk starts at or after this one
+        yield Chunk(
+            id=_chunk_id(source, page, s, body),
+            text=body,
+            source=source,
+            page=page,
+            start=s,
+            end=e,
+            token_count=count_tokens(body),
+            tags=tags,
+        )
+
+
+def _chunk_section(source, page, text, base=0, **settings):
+    return _chunk_sections(source, page, [(base, text)], **settings)
+
+
+def _last_record_boundary(text):
+    last = None
+    for m in _SPLIT_LEVELS[0].finditer(text, max(0, len(text) - TEXT_BLOCK_CHARS)):
+        last = m
+    return last.end() if last else None
+
+
+def _record_sections(blocks, start=0):
+    """Regroup text blocks into (start offset, text) sections cut at record
+    boundaries, so no record is split. A run of 4 * TEXT_BLOCK_CHARS without
+    a blank line is cut anyway to bound memory; only there can the chunks
+    differ from chunking the whole text."""
+    carry = ""
+    for block in blocks:
+        carry += block
+        if len(carry) < TEXT_BLOCK_CHARS:
+            continue
+        cut = _last_record_boundary(carry)
+        if cut is None:
+            if len(carry) < 4 * TEXT_BLOCK_CHARS:
+                continue
+            cut = len(carry)
+        yield start, carry[:cut]
+        carry, start = carry[cut:], start + cut
+    if carry:
+        yield start, carry
+
+
+def _iter_document_chunks(source, pages, **settings):
+    """Chunk one document without ever crossing into another.
+
+    PDF pages are chunked independently. Text-file blocks are regrouped at
+    record boundaries and packed as one stream, so a text file yields the
+    same chunks as chunk_text() on its whole body. Every chunk carries the
+    file's tags; front matter is read from the first block and not chunked.
+    """
+    pages = iter(pages)
+    first = next(pages, None)
+    if first is None:
+        return
+    tags = _path_tags(source)
+    if first[0] is None:
+        matter_tags, body_start = _front_matter(first[1])
+        tags += matter_tags
+        first = (None, first[1][body_start:])
+    settings["tags"] = tuple(dict.fromkeys(t for t in tags if t))
+    if first[0] is None:
+        blocks = (text for _, text in itertools.chain([first], pages))
+        yield from _chunk_sections(source, None, _record_sections(blocks, body_start), **settings)
+        return
+    for page, text in itertools.chain([first], pages):
+        yield from _chunk_section(source, page, text, **settings)
+
+
+def chunk_text(text, source="<text>", **settings):
+    """Chunk a standalone string; settings default to CHUNK_SIZE/CHUNK_OVERLAP/CHUNK_UNIT."""
+    return list(_chunk_section(source, None, text, **settings))
+
+def _batched(iterable, n):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_and_chunk(**settings):
+    """Chunk every data file; a chunk never spans two files."""
+    chunks = []
+    for filename in _list_data_files():
+        pages = _iter_file_pages(os.path.join(DATA_FOLDER, filename))
+        chunks.extend(_iter_document_chunks(filename, pages, **settings))
+    return chunks
+
+def _new_index(dim, factory="Flat"):
+    """Empty index for factory that takes arbitrary 64-bit chunk ids.
+
+    IVF stores those ids itself and keeps a hash table from id to list entry
+    for reconstruct(); IDMap2 can't wrap it, as IVF keeps its internal ids on
+    remove_ids() and the id map would stop matching. Everything else is
+    wrapped as IDMap2,<factory>.
+    """
+    index = faiss.index_factory(dim, factory)
+    if isinstance(index, faiss.IndexIVF):
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        index = faiss.index_factory(dim, f"IDMap2,{factory}")
+    inner = _inner_index(index)
+    if isinstance(inner, (faiss.IndexIVFPQ, faiss.IndexPQ)):
+        # Polysemous codes are never used for search and make training ~100x slower
+        inner.do_polysemous_training = False
+    _apply_search_params(index)
+    return index
+
+def _embed(texts, encoder):
+    with _encoder_lock:
+        vectors = encoder.encode(texts, batch_size=EMBED_BATCH_SIZE)
+    # asarray is a no-op for the float32 arrays encoders already return
+    return np.asarray(vectors, dtype="float32")
+
+def build_index(chunks, encoder):
+    """Build an id-mapped index from Chunks; returns (index, ChunkStore)."""
+    index = None
+    store = ChunkStoreBuilder()
+    for batch in _batched(chunks, EMBED_BATCH_SIZE):
+        embeddings = _embed([c.text for c in batch], encoder)
+        if index is None:
+            index = _new_index(embeddings.shape[1])
+        index.add_with_ids(embeddings, np.asarray([c.id for c in batch], dtype="int64"))
+        store.extend(batch)
+    return index, store.build()
+
+
+class _IngestProgress:
+    """Throughput counters for an ingest run, printed every PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, interval=None):
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.start = self._last_print = time.perf_counter()
+        self.chunks = 0
+        self.bytes = 0
+        self.encode_time = 0.0
+        self.index_time = 0.0
+
+    def add(self, n_chunks, n_bytes):
+        self.chunks += n_chunks
+        self.bytes += n_bytes
+        now = time.perf_counter()
+        if self.interval and now - self._last_print >= self.interval:
+            self._last_print = now
+            print(f"[rag] ingest: {self.summary_line()}")
+
+    def rates(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return self.chunks / elapsed, self.bytes / elapsed / 1e6
+
+    def summary_line(self):
+        chunks_per_s, mb_per_s = self.rates()
+        return (f"{self.chunks:,} chunks ({chunks_per_s:,.1f} chunks/s), "
+                f"{self.bytes / 1e6:,.1f} MB ({mb_per_s:,.2f} MB/s)")
+
+# ---------------- Index factory ---------------- #
+
+def _ivf_nlist(ntotal):
+    # ~4*sqrt(n) lists, rounded to a power of two, with >= 39 training points each
+    nlist = 1 << max(4, int(round(np.log2(4 * np.sqrt(max(ntotal, 1))))))
+    return max(16, min(nlist, ntotal // 39))
+
+
+def _pq_m(dim):
+    # 8 dims per sub-quantizer (48 bytes/vector for MiniLM); m must divide dim
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def resolve_index_factory(ntotal, dim, spec=None):
+    """Turn INDEX_FACTORY (or spec) into a concrete FAISS factory string."""
+    spec = (INDEX_FACTORY if spec is None else spec).strip()
+    key = spec.lower()
+    if key == "auto":
+        if ntotal < AUTO_IVF_MIN_VECTORS:
+            key = "flat"
+        elif ntotal < AUTO_PQ_MIN_VECTORS:
+            key = "ivf-flat"
+        else:
+            key = "ivf-pq"
+    if key == "flat":
+        return "Flat"
+    if key in ("ivf-flat", "ivfflat"):
+        return f"IVF{_ivf_nlist(ntotal)},Flat"
+    if key in ("ivf-pq", "ivfpq"):
+        return f"IVF{_ivf_nlist(ntotal)},PQ{_pq_m(dim)}"
+    if key == "hnsw":
+        return "HNSW32"
+    if key in ("sq-fp16", "sqfp16", "fp16"):
+        return "SQfp16"      # 2 bytes/dim
+    if key == "sq8":
+        return "SQ8"         # 1 byte/dim
+    if key == "pq":
+        return f"PQ{_pq_m(dim)}"
+    if key in ("ivf-sq8", "ivfsq8"):
+        return f"IVF{_ivf_nlist(ntotal)},SQ8"
+    return spec
+
+
+def _sq_name(sq):
+    names = {
+        faiss.ScalarQuantizer.QT_8bit: "SQ8",
+        faiss.ScalarQuantizer.QT_4bit: "SQ4",
+        faiss.ScalarQuantizer.QT_fp16: "SQfp16",
+    }
+    return names.get(sq.qtype, f"SQ(qtype={sq.qtype})")
+
+
+def _inner_index(index):
+    """The index doing the work: the one inside IDMap2, or index itself (IVF)."""
+    return faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+
+
+def _index_ids(index):
+    """int64 array of every id in index (insertion order, per list for IVF)."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+    invlists = index.invlists
+    blocks = [np.zeros(0, dtype="int64")]
+    for list_no in range(index.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            ptr = invlists.get_ids(list_no)
+            blocks.append(faiss.rev_swig_ptr(ptr, size).copy())
+            invlists.release_ids(list_no, ptr)
+    return np.concatenate(blocks)
+
+
+def index_factory_of(index):
+    """Best-effort factory string describing an index made by _new_index()."""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexFlat):
+        return "Flat"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return _sq_name(inner.sq)
+    if isinstance(inner, faiss.IndexPQ):
+        return f"PQ{inner.pq.M}"
+    if isinstance(inner, faiss.IndexHNSW):
+        return f"HNSW{inner.hnsw.nb_neighbors(1)}"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return f"IVF{inner.nlist},PQ{inner.pq.M}"
+    if isinstance(inner, faiss.IndexIVFScalarQuantizer):
+        return f"IVF{inner.nlist},{_sq_name(inner.sq)}"
+    if isinstance(inner, faiss.IndexIVF):
+        return f"IVF{inner.nlist},Flat"
+    return type(inner).__name__
+
+
+def _apply_search_params(index):
+    """Set runtime knobs (nprobe for IVF, efSearch for HNSW) on index."""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = min(NPROBE, inner.nlist)
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = EF_SEARCH
+
+
+def _enable_reconstruct(index):
+    """Let IVF indexes reconstruct vectors by id (needed to score results
+    without kept vectors). _new_index() already sets this up; this covers IVF
+    indexes made elsewhere. Done before publishing, never on a live index."""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.no():
+        inner.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def _supports_remove(index):
+    return not isinstance(_inner_index(index), faiss.IndexHNSW)
+
+
+def _iter_index_vectors(index, block=65536):
+    """Yield (ids, vectors) blocks of every vector in index."""
+    ids = _index_ids(index)
+    inner = _inner_index(index)
+    for start in range(0, len(ids), block):
+        block_ids = ids[start:start + block]
+        if isinstance(inner, faiss.IndexFlatCodes):
+            # Flat, SQ and PQ; compressed codes decode to approximations
+            vectors = inner.reconstruct_n(start, len(block_ids))
+        else:
+            # IVF looks each id up in its direct map
+            vectors = index.reconstruct_batch(block_ids)
+        yield block_ids, vectors
+
+
+def convert_index(index, factory, train_sample=None, seed=0):
+    """Copy every vector of index into a new _new_index(factory) index.
+
+    Indexes that need training (IVF, PQ, SQ) are trained on a deterministic
+    random sample of up to train_sample vectors (default 256 per IVF list, at
+    least 16k). Falls back to Flat when there are too few vectors to train.
+    """
+    dim, ntotal = index.d, index.ntotal
+    new = _new_index(dim, factory)
+    if not new.is_trained:
+        # k-means needs at least one point per centroid (IVF lists, 256 PQ codes)
+        inner = _inner_index(new)
+        nlist = inner.nlist if isinstance(inner, faiss.IndexIVF) else 1
+        min_points = max(nlist, 256 if "PQ" in factory else 1)
+        if ntotal < min_points:
+            print(f"[rag] {ntotal} vectors are too few to train {factory}; using Flat")
+            return index if index_factory_of(index) == "Flat" else convert_index(index, "Flat")
+        n_sample = min(ntotal, train_sample or max(256 * nlist, 16_384))
+        ids = _index_ids(index)
+        picked = np.random.default_rng(seed).choice(ntotal, n_sample, replace=False)
+        sample = np.vstack([index.reconstruct(int(ids[i])) for i in np.sort(picked)])
+        new.train(sample)
+    for block_ids, vectors in _iter_index_vectors(index):
+        new.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), block_ids)
+    _apply_search_params(new)
+    return new
+
+
+def rerank_exact(queries, candidates, vectors_of, k, with_distances=False):
+    """Re-order each query's candidate ids by exact L2 distance, keep k.
+
+    candidates is the (nq, k') id matrix of an approximate search (-1 = no
+    hit); vectors_of(ids) returns their full-precision vectors. Returns an
+    (nq, k) int64 id matrix padded with -1, or (distances, ids) like
+    index.search() with with_distances.
+    """
+    out = np.full((len(queries), k), -1, dtype="int64")
+    distances = np.full((len(queries), k), np.inf, dtype="float32")
+    for r, (query, row) in enumerate(zip(queries, candidates)):
+        row = row[row >= 0]
+        if not len(row):
+            continue
+        dist = ((np.asarray(vectors_of(row), dtype="float32") - query) ** 2).sum(axis=1)
+        best = np.argsort(dist, kind="stable")[:k]
+        out[r, :len(best)] = row[best]
+        distances[r, :len(best)] = dist[best]
+    return (distances, out) if with_distances else out
+
+
+def _remove_ids(index, stale_ids):
+    """remove_ids that also works for index types without removal (HNSW) by
+    rebuilding from the surviving vectors. Returns the (possibly new) index."""
+    stale = np.asarray(stale_ids, dtype="int64")
+    if _supports_remove(index):
+        index.remove_ids(stale)
+        return index
+    new = _new_index(index.d, index_factory_of(index))
+    stale_set = set(stale.tolist())
+    for block_ids, vectors in _iter_index_vectors(index):
+        keep = np.array([i not in stale_set for i in block_ids.tolist()], dtype=bool)
+        if keep.any():
+            new.add_with_ids(np.ascontiguousarray(vectors[keep], dtype="float32"), block_ids[keep])
+    return new
+
+# ---------------- Persistent index cache ---------------- #
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def build_manifest(encoder):
+    """Describe the settings the cached index was built with.
+
+    Per-file content hashes live in the ingestion ledger, so a changed data
+    file is handled by refresh() instead of invalidating the whole cache.
+    """
+    return {
+        "format_version": CACHE_FORMAT_VERSION,
+        "encoder": encoder.name,
+        "index_spec": INDEX_FACTORY,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "chunk_unit": CHUNK_UNIT,
+        # Stored chunk token counts are only valid for the tokenizer that made them
+        "tokenizer": tokenizer_name(),
+        "keep_vectors": RERANK_FACTOR > 0,
+        "dedup": [DEDUP_THRESHOLD, DEDUP_SHINGLE, NUM_PERM] if DEDUP_THRESHOLD > 0 else None,
+    }
+
+
+def _empty_ledger():
+    return {"files": {}}
+
+
+def _cache_paths(cache_dir):
+    # The packed chunk store (chunk_store.py) and BM25 index (lexical.py) live
+    # in cache_dir alongside these
+    return (
+        os.path.join(cache_dir, "manifest.json"),
+        os.path.join(cache_dir, "index.faiss"),
+        os.path.join(cache_dir, "ledger.json"),
+    )
+
+
+def _read_index(path, use_mmap):
+    """faiss.read_index, memory-mapped read-only when use_mmap.
+
+    Flat and HNSW storage map through IO_FLAG_MMAP_IFC; index types whose
+    data can't be mapped (IVF inverted lists) fall back to a private copy.
+    """
+    if use_mmap:
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path)
+
+
+def load_cached_index(manifest, cache_dir=CACHE_DIR, use_mmap=None):
+    """Return (index, chunks, lexical, ledger, saved manifest) from disk if the
+    cache was built with the settings in manifest, else None.
+
+    With use_mmap (default MMAP_CACHE) the index, chunk store and BM25 index
+    are mapped read-only; callers must copy them before modifying (see
+    _apply_refresh).
+    """
+    use_mmap = MMAP_CACHE if use_mmap is None else use_mmap
+    manifest_path, index_path, ledger_path = _cache_paths(cache_dir)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if {k: saved.get(k) for k in manifest} != manifest:
+            return None
+        index = _read_index(index_path, use_mmap)
+        chunks = open_chunk_store(cache_dir, use_mmap)
+        lexical = open_bm25(cache_dir, use_mmap)
+        with open(ledger_path, "r", encoding="utf-8") as f:
+            ledger = json.load(f)
+    except (OSError, ValueError, RuntimeError):
+        # Missing, partial or corrupt cache — caller rebuilds
+        return None
+    if not index.ntotal == len(chunks) == len(lexical):
+        return None
+    _apply_search_params(index)
+    return index, chunks, lexical, ledger, saved
+
+
+def _write_json(path, obj, **kwargs):
+    tmp = temp_path_for(path)
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(obj, f, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        discard([tmp])
+        raise
+
+
+@contextmanager
+def _cache_lock(cache_dir=CACHE_DIR):
+    """Exclusive lock on cache_dir shared by every process using it (flock on
+    cache_dir/.lock), held around load-or-build, refresh and persist.
+
+    Workers started together against an empty cache then build it once: the
+    rest wait, and find a valid manifest when they get the lock. A cache dir
+    that can't be written (or a platform without fcntl) goes unlocked.
+    """
+    lock_file = None
+    if fcntl is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            lock_file = open(os.path.join(cache_dir, ".lock"), "a")
+        except OSError:
+            lock_file = None
+    if lock_file is None:
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_cached_index(index, chunks, lexical, ledger, manifest, cache_dir=CACHE_DIR):
+    """Persist index, chunks, BM25 index, ledger and manifest; the manifest is written last
+    so a crash mid-write never leaves a cache that looks valid. Returns True
+    on success. Callers hold _cache_lock(), so writers never interleave."""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path, index_path, ledger_path = _cache_paths(cache_dir)
+    try:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        # Written under unique temp names and renamed: processes mapping the
+        # old files keep a consistent view until they load the new ones
+        tmp = temp_path_for(index_path)
+        try:
+            faiss.write_index(index, tmp)
+            os.replace(tmp, index_path)
+        except BaseException:
+            discard([tmp])
+            raise
+        write_chunk_store(cache_dir, chunks)
+        write_bm25(cache_dir, lexical)
+        _write_json(ledger_path, ledger, indent=2)
+        _write_json(manifest_path, manifest, indent=2)
+    except (OSError, RuntimeError) as e:
+        # A read-only cache dir must never take retrieval down (faiss raises RuntimeError)
+        print(f"Could not write RAG cache to {cache_dir}: {e}")
+        return False
+    return True
+
+
+def _persist(index, chunks, lexical, ledger, manifest):
+    """Save a freshly built index and return the (index, chunks, lexical) to publish.
+
+    With MMAP_CACHE the saved files are reopened mapped, so the published
+    snapshot is backed by the shared page cache rather than this process's
+    private copy (which is freed once the caller drops it).
+    """
+    if save_cached_index(index, chunks, lexical, ledger, manifest) and MMAP_CACHE:
+        loaded = load_cached_index(manifest)
+        if loaded is not None:
+            return loaded[:3]
+    return index, chunks, lexical
+
+
+# ---------------- PDF extraction ---------------- #
+
+def _pdf_cache_path(filename, entry, cache_dir=CACHE_DIR):
+    key = json.dumps([CACHE_FORMAT_VERSION, filename, entry["mtime"], entry["size"], entry["sha256"]])
+    return os.path.join(cache_dir, "pdf_text", hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def _load_pdf_cache(filename, entry):
+    try:
+        with open(_pdf_cache_path(filename, entry), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_pdf_cache(filename, entry, pages):
+    path = _pdf_cache_path(filename, entry)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_json(path, pages, ensure_ascii=False)
+    except OSError as e:
+        print(f"Could not cache extracted text of {filename}: {e}")
+
+
+def _iter_pdf_extractions(pdfs, workers=None):
+    """Yield (filename, pages, timing) for [(filename, ledger entry)] in input order.
+
+    Cached extractions are served from disk; the rest are parsed in a process
+    pool with a bounded look-ahead window so finished-but-unconsumed PDFs do
+    not pile up in memory. Order is always the input order, which keeps
+    vector ids deterministic.
+    """
+    workers = PDF_WORKERS if workers is None else workers
+    pending = [(f, e) for f, e in pdfs]
+    if not pending:
+        return
+    executor = None
+    uncached = sum(1 for f, e in pending if not os.path.exists(_pdf_cache_path(f, e)))
+    if workers > 1 and uncached > 1:
+        # Not fork: rebuilds run beside the warmup, batching and request
+        # threads, and a forked child can inherit a lock one of them holds
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        window = deque()
+
+        def submit(filename, entry):
+            pages = _load_pdf_cache(filename, entry)
+            if pages is not None:
+                window.append((filename, entry, None, pages))
+            elif executor is not None:
+                path = os.path.join(DATA_FOLDER, filename)
+                window.append((filename, entry, executor.submit(_extract_pdf_pages, path), None))
+            else:
+                window.append((filename, entry, None, None))
+
+        pending_iter = iter(pending)
+        for filename, entry in pending_iter:
+            submit(filename, entry)
+            if len(window) >= 2 * max(workers, 1):
+                break
+        while window:
+            filename, entry, future, pages = window.popleft()
+            if pages is not None:
+                timing = {"file": filename, "pages": len(pages), "seconds": 0.0, "cached": True}
+            else:
+                if future is not None:
+                    pages, seconds = future.result()
+                else:
+                    pages, seconds = _extract_pdf_pages(os.path.join(DATA_FOLDER, filename))
+                _save_pdf_cache(filename, entry, pages)
+                timing = {"file": filename, "pages": len(pages), "seconds": seconds, "cached": False}
+            for next_filename, next_entry in pending_iter:
+                submit(next_filename, next_entry)
+                break
+            yield filename, pages, timing
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+# ---------------- Incremental ingestion ---------------- #
+
+def _scan_data_folder(ledger):
+    """Diff data/ against the ledger.
+
+    Files whose mtime and size match the ledger are trusted without hashing.
+    Returns (changed, removed, unchanged_entries) where changed is a list of
+    (filename, ledger entry without ids, is_new).
+    """
+    changed, unchanged = [], {}
+    seen = set()
+    for filename in _list_data_files():
+        seen.add(filename)
+        path = os.path.join(DATA_FOLDER, filename)
+        st = os.stat(path)
+        old = ledger["files"].get(filename)
+        if old and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+            unchanged[filename] = old
+            continue
+        digest = _file_sha256(path)
+        entry = {"mtime": st.st_mtime, "size": st.st_size, "sha256": digest}
+        if old and old["sha256"] == digest:
+            # Touched but identical — keep the vectors, just record the new stat
+            unchanged[filename] = dict(old, **entry)
+            continue
+        changed.append((filename, entry, old is None))
+    removed = [f for f in ledger["files"] if f not in seen]
+    return changed, removed, unchanged
+
+
+def _requeue_duplicate_holders(ledger, changed, removed, unchanged):
+    """Move unchanged files back into changed when chunks they dropped as
+    near-duplicates were only represented by chunks that are going away.
+
+    Ledger entries list those kept ids under "dup_of"; re-ingesting the file
+    lets its own copy take their place. Repeats until nothing else moves.
+    """
+    stale = {i for f in removed for i in ledger["files"][f]["ids"]}
+    stale.update(i for f, _, is_new in changed if not is_new for i in ledger["files"][f]["ids"])
+    while True:
+        requeue = [f for f, e in unchanged.items() if stale.intersection(e.get("dup_of", ()))]
+        if not requeue:
+            break
+        for filename in requeue:
+            entry = unchanged.pop(filename)
+            changed.append((filename, {k: entry[k] for k in ("mtime", "size", "sha256")}, False))
+            stale.update(entry["ids"])
+    changed.sort(key=lambda c: c[0])
+
+
+def _bytes_per_vector(index):
+    """Approximate index bytes one vector costs: its code plus its id."""
+    try:
+        code = _inner_index(index).sa_code_size()
+    except RuntimeError:
+        code = index.d * 4
+    return code + 8
+
+
+def _apply_refresh(index, chunks, lexical, ledger, encoder, copy=False):
+    """Bring (index, chunks, lexical, ledger) in sync with data/; ledger is
+    updated in place.
+
+    Returns (index, chunks, lexical, report). chunks is a ChunkStore and
+    lexical a BM25Index; when anything changed new ones are built (kept rows
+    are copied as raw bytes and existing postings, so only new chunks are
+    tokenized). With
+    copy=True the index is copied before the first change, so a published
+    (possibly read-only mapped) index is never touched and a no-op refresh
+    copies nothing.
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    changed, removed, unchanged = _scan_data_folder(ledger)
+    _requeue_duplicate_holders(ledger, changed, removed, unchanged)
+    timings["scan"] = time.perf_counter() - t0
+    if copy and (changed or removed):
+        t0 = time.perf_counter()
+        # clone_index would keep viewing mapped storage; a serialize round
+        # trip always yields an owned, writable copy
+        index = faiss.deserialize_index(faiss.serialize_index(index))
+        _apply_search_params(index)
+        timings["copy"] = time.perf_counter() - t0
+
+    # Drop vectors of deleted/replaced files, then stream the new ones in
+    t0 = time.perf_counter()
+    stale_ids = [i for f in removed for i in ledger["files"][f]["ids"]]
+    stale_ids += [i for f, _, is_new in changed if not is_new for i in ledger["files"][f]["ids"]]
+    if stale_ids:
+        index = _remove_ids(index, stale_ids)
+    store = lex = dedup = None
+    if changed or removed:
+        store = ChunkStoreBuilder(keep_vectors=RERANK_FACTOR > 0, keep_minhash=DEDUP_THRESHOLD > 0)
+        store.copy_from(chunks, exclude=stale_ids)
+        lex = BM25Builder()
+        lex.copy_from(lexical, exclude=stale_ids)
+    timings["remove"] = time.perf_counter() - t0
+    lexical_time = 0.0
+    if changed and DEDUP_THRESHOLD > 0:
+        # Seeded with the signatures of every chunk that stays in the index
+        dedup = NearDuplicateFilter(
+            DEDUP_THRESHOLD, DEDUP_SHINGLE, seed_signatures=chunks.minhash,
+            seed_ids=np.fromiter(chunks, dtype="int64", count=len(chunks)), ignore_ids=stale_ids)
+    dedup_time, dropped_bytes = 0.0, 0
+
+    progress = _IngestProgress()
+    new_files = {}
+    pdf_timings = []
+    pdfs = _iter_pdf_extractions([(f, e) for f, e, _ in changed if f.endswith(".pdf")])
+    for filename, entry, _ in changed:
+        ids, dup_of = [], set()
+        if filename.endswith(".pdf"):
+            _, page_texts, timing = next(pdfs)
+            pages = enumerate(page_texts, start=1)
+            pdf_timings.append(timing)
+            if not timing["cached"] and progress.interval:
+                print(f"[rag] extracted {filename}: {timing['pages']} pages in {timing['seconds']:.2f}s")
+        else:
+            pages = _iter_file_pages(os.path.join(DATA_FOLDER, filename))
+        file_chunks = _iter_document_chunks(filename, pages)
+        for batch in _batched(file_chunks, EMBED_BATCH_SIZE):
+            signatures = None
+            if dedup is not None:
+                t0 = time.perf_counter()
+                kept, signatures = [], []
+                for c in batch:
+                    signature, original = dedup.check(c.id, c.text)
+                    if original is None:
+                        kept.append(c)
+                        signatures.append(signature)
+                    else:
+                        dup_of.add(original)
+                        dropped_bytes += len(c.text.encode("utf-8"))
+                dedup_time += time.perf_counter() - t0
+                batch = kept
+                if not batch:
+                    continue
+                signatures = np.vstack(signatures)
+            t0 = time.perf_counter()
+            vectors = _embed([c.text for c in batch], encoder)
+            progress.encode_time += time.perf_counter() - t0
+
+            batch_ids = [c.id for c in batch]
+            t0 = time.perf_counter()
+            index.add_with_ids(vectors, np.asarray(batch_ids, dtype="int64"))
+            progress.index_time += time.perf_counter() - t0
+
+            store.extend(batch, vectors, signatures)
+            t0 = time.perf_counter()
+            lex.extend(batch)
+            lexical_time += time.perf_counter() - t0
+            ids.extend(batch_ids)
+            progress.add(len(batch), sum(len(c.text.encode("utf-8")) for c in batch))
+        new_files[filename] = dict(entry, ids=ids)
+        # Only other files' chunks matter to _requeue_duplicate_holders
+        dup_of.difference_update(ids)
+        if dup_of:
+            new_files[filename]["dup_of"] = sorted(dup_of)
+    timings["embed"] = progress.encode_time
+    timings["index"] = progress.index_time
+    timings["dedup"] = dedup_time
+    if progress.chunks and progress.interval:
+        print(f"[rag] ingest done: {progress.summary_line()}")
+    removed_dups = dedup.removed if dedup is not None else 0
+    dedup_report = {
+        "checked": dedup.checked if dedup is not None else 0,
+        "removed": removed_dups,
+        # What the dropped chunks would have cost, at this run's encode rate
+        "embed_s_saved": removed_dups * progress.encode_time / max(progress.chunks, 1),
+        "index_bytes_saved": removed_dups * _bytes_per_vector(index),
+        "store_bytes_saved": dropped_bytes,
+    }
+    if removed_dups and progress.interval:
+        print(f"[rag] dedup: dropped {removed_dups:,} of {dedup.checked:,} chunks as near-duplicates, "
+              f"saving ~{dedup_report['embed_s_saved']:.1f}s of embedding and "
+              f"~{(dedup_report['index_bytes_saved'] + dropped_bytes) / 1e6:.1f} MB")
+    chunks_per_s, mb_per_s = progress.rates()
+    if store is not None:
+        chunks = store.build()
+        t0 = time.perf_counter()
+        lexical = lex.build()
+        timings["lexical"] = lexical_time + time.perf_counter() - t0
+
+    ledger["files"] = dict(unchanged, **new_files)
+    return index, chunks, lexical, {
+        "files": {
+            "added": sum(1 for *_, is_new in changed if is_new),
+            "updated": sum(1 for *_, is_new in changed if not is_new),
+            "removed": len(removed),
+            "unchanged": len(unchanged),
+        },
+        "chunks": {"added": progress.chunks, "removed": len(stale_ids)},
+        "dedup": dedup_report,
+        "throughput": {"chunks_per_s": chunks_per_s, "mb_per_s": mb_per_s},
+        "timings": timings,
+        "pdf_extraction": pdf_timings,
+    }
+
+
+def _build_fresh(encoder, manifest):
+    """Chunk, embed and index all of data/ from scratch.
+
+    Streams into a flat index, then converts once the corpus size (and so the
+    auto index choice) is known. Returns (index, chunks, lexical, ledger,
+    manifest, report).
+    """
+    index, chunks, ledger = _new_index(encoder.dim), ChunkStore.empty(), _empty_ledger()
+    index, chunks, lexical, report = _apply_refresh(index, chunks, BM25Index.empty(), ledger, encoder)
+    factory = resolve_index_factory(index.ntotal, index.d)
+    if factory != "Flat":
+        t0 = time.perf_counter()
+        index = convert_index(index, factory)
+        report["timings"]["convert"] = time.perf_counter() - t0
+        print(f"[rag] built {index_factory_of(index)} index over {index.ntotal:,} "
+              f"vectors in {report['timings']['convert']:.1f}s")
+        report["dedup"]["index_bytes_saved"] = report["dedup"]["removed"] * _bytes_per_vector(index)
+    manifest = dict(manifest, index_factory=index_factory_of(index))
+    return index, chunks, lexical, ledger, manifest, report
+
+
+def _run_rebuild(full):
+    """Build the next snapshot off to the side and publish it. Caller holds _refresh_lock."""
+    global _rebuild_status
+    t_start = time.perf_counter()
+    started_at = time.time()
+    _rebuild_status = {"state": "running", "full": full, "started_at": started_at}
+    try:
+        snap = _current
+        newer_on_disk = False
+        with _cache_lock():
+            if full:
+                index, chunks, lexical, ledger, manifest, report = _build_fresh(
+                    _global_encoder, build_manifest(_global_encoder))
+                changed = True
+            else:
+                # Another worker sharing the cache may have refreshed it since
+                # this one published: start from the saved cache when it's newer
+                base = (snap.index, snap.chunks, snap.lexical, snap.ledger, snap.manifest)
+                cached = load_cached_index(build_manifest(_global_encoder))
+                if (cached is not None and cached[3] != snap.ledger
+                        and os.path.getmtime(_cache_paths(CACHE_DIR)[0]) > snap.published_at):
+                    base, newer_on_disk = cached, True
+                index, chunks, lexical, published_ledger, manifest = base
+                ledger = json.loads(json.dumps(published_ledger))
+                index, chunks, lexical, report = _apply_refresh(
+                    index, chunks, lexical, ledger, _global_encoder, copy=True)
+                changed = ledger != published_ledger
+            if changed:
+                t0 = time.perf_counter()
+                index, chunks, lexical = _persist(index, chunks, lexical, ledger, manifest)
+                report["timings"]["save"] = time.perf_counter() - t0
+        version = snap.version
+        if changed or newer_on_disk:
+            version = _publish_index(index, chunks, lexical, ledger, manifest).version
+    except Exception as e:
+        _rebuild_status = {"state": "failed", "full": full, "started_at": started_at,
+                           "error": f"{type(e).__name__}: {e}",
+                           "duration_s": time.perf_counter() - t_start}
+        raise
+    report.update(full=full, version=version, duration_s=time.perf_counter() - t_start)
+    _rebuild_status = {"state": "done", "full": full, "started_at": started_at,
+                       "duration_s": report["duration_s"], "version": version,
+                       "files": report["files"], "chunks": report["chunks"],
+                       "dedup": report["dedup"]}
+    return report
+
+
+def _rebuild_worker(full):
+    try:
+        _run_rebuild(full)
+    except Exception as e:
+        print(f"[rag] rebuild failed: {e}")
+    finally:
+        _refresh_lock.release()
+
+
+def rebuild(full=False, background=False):
+    """Build a new index snapshot while the current one keeps serving.
+
+    full=False syncs the index with data/ incrementally (see refresh());
+    full=True re-chunks and re-embeds everything and re-picks the index type.
+    Either way the result is published with a single reference swap:
+    in-flight retrievals finish on the old snapshot, later ones see the new.
+
+    With background=True the work runs on a "rag-rebuild" thread and the
+    current rebuild_status() is returned at once; if a rebuild is already
+    running nothing new is started. Otherwise blocks and returns the report
+    (file/chunk counts, timings, duration_s and the published version).
+    """
+    global _rebuild_status
+    _initialize_rag_components()
+    if not background:
+        with _refresh_lock:
+            return _run_rebuild(full)
+    if not _refresh_lock.acquire(blocking=False):
+        return dict(rebuild_status(), started=False)
+    # Mark as running before returning so a status poll can't see the old result
+    _rebuild_status = {"state": "running", "full": full, "started_at": time.time()}
+    threading.Thread(target=_rebuild_worker, args=(full,), name="rag-rebuild", daemon=True).start()
+    return dict(rebuild_status(), started=True)
+
+
+def rebuild_status():
+    """State of the last rebuild (idle/running/done/failed) plus the live version."""
+    snap = _current
+    return dict(_rebuild_status, live_version=snap.version if snap else 0)
+
+
+def refresh():
+    """Sync the index with data/: embed new or changed files, drop deleted ones.
+
+    Unchanged files cost one os.stat. The refresh is applied to a copy of the
+    index and published afterwards, so concurrent retrieve_context() calls
+    keep searching the previous version. Returns a report dict with file and
+    chunk counts plus per-phase timings in seconds.
+    """
+    return rebuild(full=False)
+
+
+# ---------------- Retrieval caches ---------------- #
+
+class _LRUCache:
+    """Thread-safe size-bounded LRU with optional TTL and hit/miss counters."""
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# normalized query -> embedding, and (normalized query, top_k, index version) -> chunk ids
+_embedding_cache = _LRUCache(EMBED_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+_result_cache = _LRUCache(RESULT_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+_filter_cache = _LRUCache(64)   # (index version, tags, mode) -> (_IdFilter or None,)
+
+
+def _normalize_query(query):
+    query = " ".join(query.split())
+    # Lowercasing only merges cache entries when the encoder ignores case anyway
+    if _global_encoder is not None and _global_encoder.lowercase:
+        query = query.lower()
+    return query
+
+
+def _publish_index(index, chunks, lexical, ledger, manifest):
+    """Swap in a new snapshot and drop cached results of the old one.
+
+    Publishers are serialized (initialization, or _refresh_lock), so the
+    version bump needs no lock; readers only ever see a complete snapshot.
+    Query embeddings stay cached: the encoder doesn't change on a rebuild.
+    """
+    global _current
+    if chunks.vectors is None:
+        _enable_reconstruct(index)
+    snap = _Snapshot(index, chunks, lexical, ledger, manifest,
+                     version=_current.version + 1 if _current else 1,
+                     published_at=time.time())
+    _current = snap
+    _result_cache.clear()
+    _filter_cache.clear()
+    return snap
+
+
+def cache_stats():
+    """Hit/miss/eviction counters of the retrieval caches, for sizing them."""
+    return {
+        "index_version": _current.version if _current else 0,
+        "embedding_cache": _embedding_cache.stats(),
+        "result_cache": _result_cache.stats(),
+    }
+
+# ---------------- Query encoding ---------------- #
+
+class _BatchingEncoder:
+    """Micro-batches concurrent single-query encodes on one worker thread.
+
+    Callers enqueue a query and block on a Future; the worker takes the first
+    waiting query, gathers more for up to max_wait_ms or max_batch items, and
+    encodes them all in one model call. The wait is skipped while traffic is
+    sequential (last batch had one query), so a lone caller pays no delay.
+    """
+
+    def __init__(self, encoder, max_batch=None, max_wait_ms=None):
+        self.encoder = encoder
+        self.max_batch = QUERY_BATCH_SIZE if max_batch is None else max_batch
+        self.max_wait = (QUERY_BATCH_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._last_batch_size = 1
+        self._worker = threading.Thread(target=self._run, name="rag-query-encoder", daemon=True)
+        self._worker.start()
+
+    def encode(self, texts):
+        """Return the float32 embeddings of texts, one row each. The texts
+        are queued together, so they share a model call unless it's full."""
+        futures = [Future() for _ in texts]
+        for item in zip(texts, futures):
+            self._queue.put(item)
+        return np.vstack([future.result() for future in futures])
+
+    def _gather(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                # Whatever is already queued is taken without waiting
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self._last_batch_size == 1 and len(batch) == 1:
+                break
             try:
-                reader = PdfReader(file_path)
-                for page in reader.pages:
-                    content = page.extract_text()
-                    if content: # SAFETY FIX FOR NONE-TYPE
-                        all_text += str(content).strip() + "\n"
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            try:
+                vectors = _embed([text for text, _ in batch], self.encoder)
             except Exception as e:
-                print(f"Error reading {filename}: {e}")
-    return all_text
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+def _query_segments(query):
+    """query split into encoder-sized segments ([query] when it fits)."""
+    limit = QUERY_SEGMENT_TOKENS
+    # A token spans at least one character, so short queries skip the tokenizer
+    if limit <= 0 or len(query) <= limit or _measure(query, "tokens") <= limit:
+        return [query]
+    units = _split_units(query, 0, len(query), limit, "tokens")
+    return [query[s:e] for s, e in _pack_units(units, limit, 0, _separators(query, "tokens"))]
 
-def load_and_chunk(chunk_size=500):
-    text = get_text_from_files()
-    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size) if text[i:i+chunk_size].strip()]
-    return chunks or ["No data"]
+def _encode_segments(segments):
+    """Query embeddings, one row per segment, through the query batcher (or
+    directly when batching is off)."""
+    if QUERY_BATCHING:
+        return _global_batcher.encode(segments)
+    return _embed(segments, _global_encoder)
+
+def _encode_query(query):
+    """Embeddings of an already-normalized query, one row per segment (see
+    _query_segments()), via the embedding cache."""
+    vectors = _embedding_cache.get(query)
+    if vectors is None:
+        vectors = _encode_segments(_query_segments(query))
+        _embedding_cache.put(query, vectors)
+    return vectors
 
-def build_index(chunks, model):
-    embeddings = model.encode(chunks)
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(np.array(embeddings).astype("float32"))
-    return index, chunks
 
 def _initialize_rag_components():
     """Thread-safe lazy initialization of RAG components."""
-    global _rag_initialized, _global_chunks, _global_index, _global_model
-    
+    global _rag_initialized, _global_encoder, _global_batcher
+    global _rag_state, _rag_error, _warmup_seconds
+
     if not _rag_initialized:
         with _rag_lock:
             if not _rag_initialized:  # Double-check locking
-                _global_model = SentenceTransformer("all-MiniLM-L6-v2")
-                chunks_list = load_and_chunk()
-                _global_index, _global_chunks = build_index(chunks_list, _global_model)
+                _rag_state, _rag_error = "loading", None
+                t_start = time.perf_counter()
+                try:
+                    _global_encoder = get_encoder()
+                    manifest = build_manifest(_global_encoder)
+                    # Checked under the lock: a worker that waited on another
+                    # one's build loads its cache instead of building again
+                    with _cache_lock():
+                        cached = load_cached_index(manifest)
+                        if cached is not None:
+                            index, chunks, lexical, ledger, manifest = cached
+                            before = json.dumps(ledger, sort_keys=True)
+                            index, chunks, lexical, _ = _apply_refresh(
+                                index, chunks, lexical, ledger, _global_encoder, copy=True)
+                            if json.dumps(ledger, sort_keys=True) != before:
+                                index, chunks, lexical = _persist(index, chunks, lexical, ledger, manifest)
+                        else:
+                            index, chunks, lexical, ledger, manifest, _ = _build_fresh(_global_encoder, manifest)
+                            index, chunks, lexical = _persist(index, chunks, lexical, ledger, manifest)
+                    _publish_index(index, chunks, lexical, ledger, manifest)
+                    _global_batcher = _BatchingEncoder(_global_encoder)
+                except Exception as e:
+                    _rag_state, _rag_error = "failed", f"{type(e).__name__}: {e}"
+                    raise
                 _rag_initialized = True
+                _warmup_seconds = time.perf_counter() - t_start
+                _rag_state = "ready"
+                _ready_event.set()
+
+# ---------------- Warm-up and readiness ---------------- #
+
+def _warmup_worker(retry=False):
+    global _warmup_retry_at
+    delay = WARMUP_RETRY
+    while True:
+        try:
+            _initialize_rag_components()
+            return
+        except Exception as e:
+            if not retry or delay <= 0:
+                print(f"[rag] warmup failed: {e}")
+                return
+            print(f"[rag] warmup failed: {e}; retrying in {delay:g}s")
+        _warmup_retry_at = time.monotonic() + delay
+        time.sleep(delay)
+        _warmup_retry_at = None
+        delay = min(delay * 2, WARMUP_RETRY_MAX)
+
+
+def warmup(background=False):
+    """Load the encoder and index now instead of inside the first request.
+
+    With background=True the work runs in a daemon thread and this returns
+    immediately; poll rag_status() or wait on readiness. A failed background
+    attempt is retried with backoff (RAG_WARMUP_RETRY). Calling it again is a
+    no-op unless the previous attempt failed. Returns the current state.
+    """
+    global _warmup_thread
+    with _warmup_lock:
+        if _rag_state in ("loading", "ready"):
+            return _rag_state
+        if background:
+            if _warmup_thread is None or not _warmup_thread.is_alive():
+                _warmup_thread = threading.Thread(target=_warmup_worker, args=(True,),
+                                                  name="rag-warmup", daemon=True)
+                _warmup_thread.start()
+                return "loading"
+            return _rag_state
+    _warmup_worker()
+    return _rag_state
+
+
+def rag_status():
+    """Readiness report for health checks (e.g. api.py's /ready)."""
+    state = _rag_state
+    if state == "cold" and _warmup_thread is not None and _warmup_thread.is_alive():
+        state = "loading"  # thread started but not yet inside the init lock
+    status = {"state": state, "error": _rag_error, "policy": NOT_READY_POLICY}
+    retry_at = _warmup_retry_at
+    if state == "failed" and retry_at is not None:
+        status["retry_in_s"] = round(max(retry_at - time.monotonic(), 0.0), 1)
+    if state == "ready":
+        snap = _current
+        status.update(
+            chunks=len(snap.chunks),
+            index_version=snap.version,
+            index_factory=snap.manifest.get("index_factory"),
+            hybrid=HYBRID,
+            lexical_terms=snap.lexical.vocab_size,
+            tags=sorted(snap.chunks.tags),
+            encoder=_global_encoder.name,
+            warmup_seconds=_warmup_seconds,
+        )
+    return status
+
+
+def _await_ready():
+    """True when retrieval can run; False when the request should proceed
+    without context (still loading under the "skip" policy, wait deadline
+    passed, or a warmup thread is waiting to retry). With no warmup thread
+    alive, a cold or failed state is (re)initialized inline, as before."""
+    if _rag_state == "ready":
+        return True
+    thread_alive = _warmup_thread is not None and _warmup_thread.is_alive()
+    if not thread_alive and _rag_state in ("cold", "failed"):
+        # Nobody owns the state (warmup() never called, run in the foreground,
+        # or out of retries): keep the original lazy behaviour
+        _initialize_rag_components()
+        return True
+    # A warmup thread sleeping before its next retry doesn't count: don't stall requests on it
+    warming = _rag_state == "loading" or (_rag_state == "cold" and thread_alive)
+    if warming and NOT_READY_POLICY == "wait":
+        return _ready_event.wait(READY_TIMEOUT) and _rag_state == "ready"
+    return False
+
+def format_context(results):
+    """The prompt context for search() results: their texts, blank-line separated."""
+    return "\n\n".join(r.text for r in results)
+
+def pack_results(results, max_tokens):
+    """The results, best first, that fit in a max_tokens context block.
+
+    Uses the token counts stored at ingest, so nothing is tokenized at
+    request time. A result too big for the remaining budget is skipped and
+    smaller, lower-ranked ones still get a chance.
+    """
+    packed, used = [], 0
+    for r in results:
+        cost = r.token_count + (_SEPARATOR_TOKENS if packed else 0)
+        if used + cost <= max_tokens:
+            packed.append(r)
+            used += cost
+    return packed
+
+class _IdFilter:
+    """Sorted chunk ids a filtered search may return; the FAISS selector over
+    them is built on first use and reused by every search with the filter."""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self._selector = None
+
+    def selector(self):
+        if self._selector is None:
+            self._selector = faiss.IDSelectorBatch(self.ids)
+        return self._selector
+
+def _selector_params(index, exclude=None, allow=None):
+    """faiss SearchParameters that only return ids in allow (an _IdFilter)
+    and not in exclude, carrying the index's nprobe/efSearch; None for index
+    types that take no selector (e.g. plain PQ)."""
+    inner = _inner_index(index)
+    if not isinstance(inner, (faiss.IndexIVF, faiss.IndexHNSW, faiss.IndexFlat, faiss.IndexScalarQuantizer)):
+        return None
+    parts = []
+    if allow is not None:
+        parts.append(allow.selector())
+    if exclude is not None:
+        batch = faiss.IDSelectorBatch(exclude)
+        parts += [batch, faiss.IDSelectorNot(batch)]
+    selector = parts[-1] if len(parts) < 3 else faiss.IDSelectorAnd(parts[0], parts[-1])
+    if isinstance(inner, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    elif isinstance(inner, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    params.referenced_objects = parts + [selector]   # the C++ params own none of them
+    return params
+
+def _drop_ids(distances, ids, k, exclude=None, allow=None):
+    """First k entries of each row in allow and not in exclude; short rows
+    are padded with id -1 like a FAISS search."""
+    keep = ids >= 0
+    if exclude is not None:
+        keep &= ~np.isin(ids, exclude)
+    if allow is not None:
+        keep &= np.isin(ids, allow.ids)
+    order = np.argsort(~keep, axis=1, kind="stable")[:, :k]
+    kept = np.take_along_axis(keep, order, axis=1)
+    return (np.where(kept, np.take_along_axis(distances, order, axis=1), np.inf),
+            np.where(kept, np.take_along_axis(ids, order, axis=1), -1))
+
+def _search(index, chunks, queries, k, exclude=None, allow=None):
+    """(distances, ids), each (nq, k), for the query matrix, never returning
+    ids in exclude or outside allow (an _IdFilter); on a compressed index
+    with kept full-precision vectors, top k * RERANK_FACTOR candidates are
+    re-ranked."""
+    params = None
+    if exclude is not None and not len(exclude):
+        exclude = None
+    if exclude is not None or allow is not None:
+        params = _selector_params(index, exclude, allow)
+        if params is None:
+            # Over-fetch by the share of the index the filters leave, then filter
+            fetch = k + (0 if exclude is None else len(exclude))
+            if allow is not None:
+                fetch *= -(-index.ntotal // max(len(allow.ids), 1))
+            distances, ids = _search(index, chunks, queries, min(fetch, index.ntotal))
+            return _drop_ids(distances, ids, k, exclude, allow)
+    if RERANK_FACTOR <= 0 or chunks.vectors is None or index_factory_of(index) == "Flat":
+        return index.search(queries, k, params=params)
+    _, candidates = index.search(queries, k * RERANK_FACTOR, params=params)
+    return rerank_exact(queries, candidates, lambda ids: chunks.vectors[chunks.rows(ids)], k,
+                        with_distances=True)
+
+def fuse_rankings(dense_ids, dense_dist, lexical_ids, lexical_scores, k, method=None, weight=None,
+                  with_scores=False):
+    """Merge one query's dense (ids, L2 distances) and BM25 (ids, scores)
+    rankings, both best first, into at most k chunk ids.
+
+    "rrf" scores a chunk sum(1 / (RRF_K + rank)) over the lists it appears
+    in; "weighted" mixes min-max normalized dense similarity and max-scaled
+    BM25 with weight (default HYBRID_WEIGHT) on the dense side. Ties keep
+    dense order first. with_scores also returns the fused scores, scaled so
+    that 1 is the best possible (first in both rankings).
+    """
+    method = HYBRID if method is None else method
+    weight = HYBRID_WEIGHT if weight is None else weight
+    dense = [(int(i), float(d)) for i, d in zip(dense_ids, dense_dist) if i >= 0]
+    fused = {}
+    if method == "weighted":
+        if dense:
+            lo, hi = min(d for _, d in dense), max(d for _, d in dense)
+            for i, d in dense:
+                fused[i] = weight * ((hi - d) / (hi - lo) if hi > lo else 1.0)
+        top = float(lexical_scores[0]) if len(lexical_scores) else 0.0
+        for i, score in zip(lexical_ids.tolist(), lexical_scores.tolist()):
+            fused[i] = fused.get(i, 0.0) + (1 - weight) * (score / top if top > 0 else 0.0)
+    else:
+        for rank, (i, _) in enumerate(dense, start=1):
+            fused[i] = 1.0 / (RRF_K + rank)
+        for rank, i in enumerate(lexical_ids.tolist(), start=1):
+            fused[i] = fused.get(i, 0.0) + 1.0 / (RRF_K + rank)
+    ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+    if not with_scores:
+        return ranked
+    top = 1.0 if method == "weighted" else 2.0 / (RRF_K + 1)
+    return ranked, [fused[i] / top for i in ranked]
+
+def adaptive_cutoff(scores, min_score=None, gap=None):
+    """How many of scores (sorted best first) to keep: stop below min_score
+    (default MIN_SCORE) or at the first drop larger than gap (default
+    SCORE_GAP) between neighbours. 0 disables either rule."""
+    min_score = MIN_SCORE if min_score is None else min_score
+    gap = SCORE_GAP if gap is None else gap
+    scores = np.asarray(scores, dtype="float32")
+    n = len(scores)
+    if min_score > 0:
+        n = int(np.count_nonzero(scores >= min_score))
+    if gap > 0 and n > 1:
+        drops = np.flatnonzero(scores[:n - 1] - scores[1:n] > gap)
+        if len(drops):
+            n = int(drops[0]) + 1
+    return n
+
+def _relevance(unit, query):
+    """Cosine similarity of unit-norm rows to query; a multi-row (segmented)
+    query scores each row by its best segment."""
+    q = np.asarray(query, dtype="float32").reshape(-1, unit.shape[1])
+    q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+    return (unit @ q.T).max(axis=1)
+
+def mmr_select(query, vectors, k, lam=None, relevance=None):
+    """Indices of k rows of vectors picked by Maximal Marginal Relevance.
 
-def retrieve_context(query, top_k=3):
-    """Thread-safe context retrieval - lock only for encoding."""
+    Cosine similarities to the query and between all candidates come from
+    one matrix product; each greedy step is then a vector update. lam=1 is
+    plain relevance order, lower values trade relevance for diversity.
+    relevance replaces the cosine similarity to the query (e.g. fused
+    hybrid scores); diversity is always measured between the vectors.
+    """
+    lam = MMR_LAMBDA if lam is None else lam
+    vectors = np.asarray(vectors, dtype="float32")
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    if relevance is None:
+        relevance = _relevance(unit, query)
+    relevance = np.asarray(relevance, dtype="float32")
+    similarity = unit @ unit.T
+    closest = np.zeros(len(vectors), dtype="float32")
+    available = np.ones(len(vectors), dtype=bool)
+    picked = []
+    for _ in range(min(k, len(vectors))):
+        score = np.where(available, lam * relevance - (1 - lam) * closest, -np.inf)
+        j = int(np.argmax(score))
+        picked.append(j)
+        available[j] = False
+        closest = np.maximum(closest, similarity[j])
+    return picked
+
+def _chunk_vectors(snap, ids):
+    """Vectors of chunk ids: the kept full-precision ones if the chunk store
+    has them, else reconstructed from the index (decoded if compressed)."""
+    ids = np.asarray(ids, dtype="int64")
+    if snap.chunks.vectors is not None:
+        return np.asarray(snap.chunks.vectors[snap.chunks.rows(ids)], dtype="float32")
+    return snap.index.reconstruct_batch(ids)
+
+def _shaping_enabled():
+    return MMR_LAMBDA < 1 or MIN_SCORE > 0 or SCORE_GAP > 0
+
+def _score_results(snap, query, ids, k, fused=None):
+    """Score one query's ranked candidate ids and, when enabled, apply the
+    adaptive cutoffs and then MMR. Scores are the fused ones when given
+    (hybrid ranking, kept in its order), else cosine similarity to the
+    query. Returns up to k (chunk id, score) pairs."""
+    ids = [i for i in ids if i >= 0]
+    if not ids:
+        return ()
+    vectors = None
+    if fused is None or MMR_LAMBDA < 1:
+        vectors = _chunk_vectors(snap, ids)
+    if fused is None:
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        relevance = _relevance(unit, query)
+    else:
+        relevance = np.asarray(fused, dtype="float32")
+    order = np.arange(len(ids))
+    if _shaping_enabled():
+        if fused is None:
+            order = np.argsort(-relevance, kind="stable")
+        order = order[:adaptive_cutoff(relevance[order])]
+        if MMR_LAMBDA < 1:
+            order = order[mmr_select(query, vectors[order], k, relevance=relevance[order])]
+    return tuple((ids[j], float(relevance[j])) for j in order[:k].tolist())
+
+def _search_scored(snap, query_texts, query_vectors, k, exclude=None, allow=None):
+    """One tuple of up to k (chunk id, score) pairs per query: the dense
+    ranking, fused with BM25 over query_texts unless HYBRID is "off", then
+    shaped by MMR and the adaptive cutoffs when enabled. query_vectors holds
+    one (segments, dim) matrix per query; ids in exclude or outside allow
+    are never returned."""
+    fetch = k * max(MMR_FETCH, 1) if MMR_LAMBDA < 1 else k
+    found = _ranked_ids(snap, query_texts, query_vectors, fetch, exclude, allow)
+    return [_score_results(snap, v, ids, k, fused) for v, (ids, fused) in zip(query_vectors, found)]
+
+def _merge_segments(distances, ids, k):
+    """Best k (distances, ids) over several segment rows, each chunk at its
+    smallest distance."""
+    distances, ids = distances.ravel(), ids.ravel()
+    order = np.argsort(distances, kind="stable")
+    order = order[ids[order] >= 0]
+    _, first = np.unique(ids[order], return_index=True)
+    best = order[np.sort(first)][:k]
+    return distances[best], ids[best]
+
+def _dense_rankings(snap, query_vectors, k, exclude=None, allow=None):
+    """(distances, ids) of each query's k best chunks, from a single search
+    over the segment rows of all queries."""
+    distances, found = _search(snap.index, snap.chunks, np.vstack(query_vectors), k, exclude, allow)
+    rankings, start = [], 0
+    for vectors in query_vectors:
+        end = start + len(vectors)
+        if end - start == 1:
+            rankings.append((distances[start], found[start]))
+        else:
+            rankings.append(_merge_segments(distances[start:end], found[start:end], k))
+        start = end
+    return rankings
+
+def _ranked_ids(snap, query_texts, query_vectors, k, exclude=None, allow=None):
+    """Each query's (ranked ids, fused scores), fused scores None when dense only."""
+    if HYBRID == "off" or not len(snap.lexical):
+        return [(tuple(i for i in ids.tolist() if i >= 0), None)
+                for _, ids in _dense_rankings(snap, query_vectors, k, exclude, allow)]
+    depth = k * max(HYBRID_DEPTH, 1)
+    allowed = None if allow is None else allow.ids
+    results = []
+    for text, (dist, ids) in zip(query_texts, _dense_rankings(snap, query_vectors, depth, exclude, allow)):
+        lexical_scores, lexical_ids = snap.lexical.search(text, depth, allowed, exclude)
+        ranked, fused = fuse_rankings(ids, dist, lexical_ids, lexical_scores, k, with_scores=True)
+        results.append((tuple(ranked), tuple(fused)))
+    return results
+
+def _snapshot():
+    # A single reference read: the snapshot is immutable once published
+    return _current
+
+class _RecentChunks:
+    """Ring buffer of the last capacity chunk ids served to one session."""
+
+    def __init__(self, capacity):
+        self._ids = np.full(capacity, -1, dtype="int64")
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add(self, ids):
+        with self._lock:
+            for chunk_id in ids:
+                self._ids[self._added % len(self._ids)] = chunk_id
+                self._added += 1
+
+    def latest(self, limit):
+        """Up to limit of the most recently served ids, sorted and distinct."""
+        with self._lock:
+            n = min(self._added, len(self._ids), limit)
+            return np.unique(self._ids[(self._added - 1 - np.arange(n)) % len(self._ids)])
+
+
+_sessions = _LRUCache(RECENT_SESSIONS, RETRIEVAL_CACHE_TTL)   # session id -> _RecentChunks
+_sessions_lock = threading.Lock()
+
+def mark_served(session_id, results):
+    """Record results as used in session_id's prompt; later searches for that
+    session skip them."""
+    if session_id is None or RECENT_CHUNKS <= 0 or not results:
+        return
+    with _sessions_lock:
+        recent = _sessions.get(session_id)
+        if recent is None:
+            recent = _RecentChunks(RECENT_CHUNKS)
+            _sessions.put(session_id, recent)
+    recent.add([r.chunk_id for r in results])
+
+def forget_session(session_id):
+    """Drop session_id's served-chunk history (e.g. when its chat is cleared)."""
+    if RECENT_CHUNKS > 0:
+        with _sessions_lock:
+            _sessions.put(session_id, _RecentChunks(RECENT_CHUNKS))
+
+def _excluded_ids(session_id, pool, top_k):
+    """Recently served ids to skip for session_id, leaving at least top_k of
+    the pool chunks the search can return."""
+    if session_id is None or RECENT_CHUNKS <= 0:
+        return None
+    recent = _sessions.get(session_id)
+    if recent is None:
+        return None
+    excluded = recent.latest(max(pool - top_k, 0))
+    return excluded if len(excluded) else None
+
+def _search_filter(snap, tags=None, mode=None):
+    """_IdFilter of the chunks matching tags (any of them) and mode, or None
+    when every chunk matches. Cached per index version."""
+    if not tags and not mode:
+        return None
+    tags = frozenset(normalize_tag(t) for t in tags) if tags else None
+    mode = normalize_tag(mode) if mode else None
+    key = (snap.version, tags, mode)
+    cached = _filter_cache.get(key)
+    if cached is None:
+        chunks = snap.chunks
+        ids = reduce(np.union1d, (chunks.tag_ids(t) for t in tags)) if tags else chunks.ids()
+        if mode:
+            # chunks tagged for another mode are out unless also tagged for this one
+            other = reduce(np.union1d, (chunks.tag_ids(m) for m in MODE_TAGS - {mode}), np.empty(0, "int64"))
+            other = np.setdiff1d(other, chunks.tag_ids(mode), assume_unique=True)
+            ids = np.setdiff1d(ids, other, assume_unique=True)
+        cached = (None if len(ids) == len(snap.chunks) else _IdFilter(ids),)
+        _filter_cache.put(key, cached)
+    return cached[0]
+
+def _to_results(hits, chunks):
+    return [SearchResult(chunk_id, score, _chunks=chunks, **{
+                k: v for k, v in chunks.meta(chunk_id).items() if k in ("source", "page", "token_count", "tags")})
+            for chunk_id, score in hits if chunk_id in chunks]
+
+def _result_key(query, top_k, snap, allow, tags, mode):
+    if allow is None:
+        return query, top_k, snap.version
+    return query, top_k, snap.version, tuple(sorted(tags or ())), mode
+
+def search(query, top_k=3, session_id=None, tags=None, mode=None):
+    """Thread-safe retrieval of up to top_k SearchResult records, best first.
+
+    Dense hits are fused with BM25 keyword hits over the same chunks unless
+    RAG_HYBRID=off (see fuse_rankings()), then shaped by MMR and the adaptive
+    cutoffs when enabled. Concurrent query encodes are micro-batched; a long
+    query is encoded as several segments and searched with all of them.
+
+    With session_id, chunks recently served to that session (see
+    mark_served()) are excluded inside the search. tags keeps chunks with
+    any of the tags; mode (a ROAST_MODES name such as "Professional 💼")
+    keeps chunks tagged for that mode or for no mode. Filters are applied
+    by the index search itself, so top_k matching chunks come back even
+    when the filter is narrow.
+
+    Repeated queries are served from the result cache (keyed by normalized
+    query, top_k, filters and index version) without encoding or searching,
+    unless a session exclusion applies. While a background warmup() is still
+    running the NOT_READY_POLICY applies and an empty list may be returned.
+    """
+    if not _await_ready():
+        return []
+
+    query = _normalize_query(query)
+    # FAISS reads are thread-safe; rebuilds publish a new snapshot rather than mutating this one
+    snap = _snapshot()
+    if snap.index.ntotal == 0:
+        return []
+    allow = _search_filter(snap, tags, mode)
+    if allow is not None and not len(allow.ids):
+        return []
+    pool = snap.index.ntotal if allow is None else len(allow.ids)
+    exclude = _excluded_ids(session_id, pool, top_k)
+    if exclude is not None:
+        hits = _search_scored(snap, [query], [_encode_query(query)], top_k, exclude, allow)[0]
+        return _to_results(hits, snap.chunks)
+    key = _result_key(query, top_k, snap, allow, tags, mode)
+    hits = _result_cache.get(key)
+    if hits is None:
+        hits = _search_scored(snap, [query], [_encode_query(query)], top_k, allow=allow)[0]
+        _result_cache.put(key, hits)
+    return _to_results(hits, snap.chunks)
+
+def search_batch(queries, top_k=3, tags=None, mode=None):
+    """Batch variant of search() for offline jobs.
+
+    Queries missing from the caches are encoded together along the same path
+    as search()'s, then searched with a single search over the stacked query
+    matrix.
+    Returns one result list per query, in input order.
+    """
+    if not queries:
+        return []
     _initialize_rag_components()
-    
-    # Encode with lock, search without (FAISS reads are thread-safe)
-    with _rag_lock:
-        query_embedding = _global_model.encode([query])
-    
-    _, indices = _global_index.search(np.array(query_embedding).astype("float32"), top_k)
-    return "\n\n".join([_global_chunks[i] for i in indices[0] if i < len(_global_chunks)])
\ No newline at end of file
+    queries = [_normalize_query(q) for q in queries]
+
+    snap = _snapshot()
+    allow = _search_filter(snap, tags, mode)
+    if snap.index.ntotal == 0 or allow is not None and not len(allow.ids):
+        return [[] for _ in queries]
+    results = [_result_cache.get(_result_key(q, top_k, snap, allow, tags, mode)) for q in queries]
+    missing = sorted({q for q, hits in zip(queries, results) if hits is None})
+    if missing:
+        vectors = [_embedding_cache.get(q) for q in missing]
+        to_encode = [q for q, v in zip(missing, vectors) if v is None]
+        if to_encode:
+            segments = [_query_segments(q) for q in to_encode]
+            encoded = _encode_segments([s for segs in segments for s in segs])
+            encoded = iter(np.split(encoded, np.cumsum([len(segs) for segs in segments])[:-1]))
+            vectors = [next(encoded) if v is None else v for v in vectors]
+            for q, v in zip(missing, vectors):
+                _embedding_cache.put(q, v)
+        found = _search_scored(snap, missing, vectors, top_k, allow=allow)
+        fresh = dict(zip(missing, found))
+        for q, hits in fresh.items():
+            _result_cache.put(_result_key(q, top_k, snap, allow, tags, mode), hits)
+        results = [fresh[q] if hits is None else hits for q, hits in zip(queries, results)]
+    return [_to_results(hits, snap.chunks) for hits in results]
+
+def retrieve_context(query, top_k=3, max_context_tokens=None, session_id=None, tags=None, mode=None):
+    """search() formatted as one prompt context string ("" when nothing is found).
+
+    With max_context_tokens, only the best of the top_k chunks that fit in
+    that many tokens are included (see pack_results()). With session_id,
+    chunks served to that session recently are skipped, and the included
+    ones are recorded as served. tags and mode filter as in search().
+    """
+    results = search(query, top_k, session_id, tags, mode)
+    if max_context_tokens is not None:
+        results = pack_results(results, max_context_tokens)
+    mark_served(session_id, results)
+    return format_context(results)
+
+def retrieve_contexts(queries, top_k=3, max_context_tokens=None, tags=None, mode=None):
+    """search_batch() formatted as one context string per query, packed into
+    max_context_tokens each when given."""
+    batches = search_batch(queries, top_k, tags, mode)
+    if max_context_tokens is not None:
+        batches = [pack_results(results, max_context_tokens) for results in batches]
+    return [format_context(results) for results in batches]
+
+if __name__ == "__main__":
+    # Build step for multi-worker deployments: run once before starting the
+    # workers so each of them only maps the finished cache read-only
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or update the RoastBot RAG cache.")
+    parser.add_argument("--full", action="store_true", help="Re-embed everything instead of syncing changes")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    if warmup() != "ready":
+        raise SystemExit(f"[rag] build failed: {_rag_error}")
+    if args.full:
+        rebuild(full=True)
+    status = rag_status()
+    print(f"[rag] cache ready in {CACHE_DIR}: {status['chunks']:,} chunks, "
+          f"{status['index_factory']} index, {time.perf_counter() - t0:.1f}s")
@@ -0,0 +1,424 @@
+"""
+Retrieval benchmark — rag_bench.py
+
+Measures what an index choice costs and gains, fully offline:
+  • build time (train + add) through rag.convert_index()
+  • index memory footprint (serialized size), and the full-precision vectors
+    kept on disk when re-ranking
+  • query latency p50/p95/p99, single-query and batched
+  • recall@k against the exact IDMap2,Flat baseline
+
+An index spec may end in "+rerank" to search top k * --rerank candidates and
+re-score them exactly (rag.rerank_exact), as RAG_RERANK does at serve time.
+--quantization benchmarks the compressed storage options against Flat.
+--hybrid instead measures what BM25 fusion (lexical.py, RAG_HYBRID) adds to
+a dense Flat search: BM25 build time and size, single-query latency and its
+overhead over dense-only, and keyword hit@k (share of results containing the
+query word, for one-word queries).
+--filtered measures tag-filtered search (RAG metadata filters) against the
+unfiltered path: the filter applied inside the index search through a FAISS
+ID selector, as rag.search() does, versus over-fetching k / selectivity
+results and post-filtering them; latency and recall@k against the exact
+filtered top k, for a few filter selectivities.
+
+Corpora are generated from a fixed vocabulary (or loaded from a text file,
+one record per blank-line separated block) and embedded with the deterministic
+HashingEncoder from embeddings.py, so no model download or network access is
+needed.
+
+Usage:
+  python rag_bench.py                                  # 1k, 10k, 100k, 1M chunks
+  python rag_bench.py --sizes 1000 10000 --indexes flat hnsw
+  python rag_bench.py --corpus data/roast_data.txt --out results/bench
+  python rag_bench.py --quantization --sizes 100000 --rerank 4
+  python rag_bench.py --hybrid --sizes 10000 100000
+  python rag_bench.py --filtered --sizes 100000 --indexes flat hnsw ivf-flat
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+import rag
+from chunk_store import ChunkStore
+from embeddings import HashingEncoder
+from lexical import BM25Builder, tokenize
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+DEFAULT_INDEXES = ("flat", "ivf-flat", "ivf-pq", "hnsw")
+QUANTIZATION_INDEXES = ("flat", "sq-fp16", "sq8", "sq8+rerank", "pq", "pq+rerank",
+                        "ivf-pq", "ivf-pq+rerank")
+HYBRID_METHODS = ("dense", "rrf", "weighted")
+FILTER_METHODS = ("unfiltered", "selector", "post-filter")
+FILTER_SELECTIVITIES = (0.25, 0.05)
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+_BASE_VOCAB = (
+    "code bug commit deploy production python javascript rust go java kubernetes docker "
+    "segfault null pointer memory leak stack overflow github merge conflict refactor legacy "
+    "spaghetti variable function class test coverage review senior junior intern startup "
+    "api database query index cache latency timeout server cloud yaml config regex css html "
+    "framework npm package dependency build pipeline linter warning error exception crash "
+    "debug print log monitor alert pager oncall sprint standup ticket jira backlog deadline"
+).split()
+
+
+# ── Corpora ───────────────────────────────────────────────────────────────────
+
+def generate_corpus(n: int, seed: int = 0, vocab=None) -> list[str]:
+    """n synthetic roast-like chunks; word frequencies are Zipf-distributed."""
+    vocab = list(vocab or _BASE_VOCAB)
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, len(vocab) + 1)
+    weights /= weights.sum()
+    lengths = rng.integers(8, 24, size=n)
+    words = rng.choice(len(vocab), size=int(lengths.sum()), p=weights)
+    texts, pos = [], 0
+    for length in lengths:
+        texts.append(" ".join(vocab[i] for i in words[pos:pos + length]))
+        pos += length
+    return texts
+
+
+def load_corpus(path: str, n: int, seed: int = 0) -> list[str]:
+    """Records from path, topped up to n with shuffled word-level variants."""
+    with open(path, "r", encoding="utf-8") as f:
+        records = [r.strip() for r in re.split(r"\n\s*\n", f.read()) if r.strip()]
+    if len(records) >= n:
+        return records[:n]
+    vocab = sorted({w for r in records for w in _WORD_RE.findall(r.lower())})
+    return records + generate_corpus(n - len(records), seed=seed, vocab=vocab)
+
+
+# ── Measurements ──────────────────────────────────────────────────────────────
+
+def _percentiles_ms(samples) -> dict:
+    arr = np.asarray(samples) * 1000
+    return {f"p{p}": float(np.percentile(arr, p)) for p in (50, 95, 99)}
+
+
+def _index_bytes(index) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.faiss")
+        faiss.write_index(index, path)
+        return os.path.getsize(path)
+
+
+def _recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(len(set(f[f >= 0].tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def bench_index(baseline, queries: np.ndarray, truth: np.ndarray, spec: str, k: int,
+                rerank: int = 4) -> dict:
+    base_spec, _, suffix = spec.partition("+")
+    rerank = rerank if suffix == "rerank" else 0
+    factory = rag.resolve_index_factory(baseline.ntotal, baseline.d, base_spec)
+    t0 = time.perf_counter()
+    index = baseline if factory == "Flat" else rag.convert_index(baseline, factory)
+    build_s = time.perf_counter() - t0
+
+    # Baseline ids are 0..n-1, so the flat storage doubles as the "on disk"
+    # full-precision vectors that re-ranking reads
+    flat = faiss.downcast_index(baseline.index)
+
+    def search(q):
+        if not rerank:
+            return index.search(q, k)[1]
+        _, candidates = index.search(q, k * rerank)
+        return rag.rerank_exact(q, candidates, flat.reconstruct_batch, k)
+
+    single = []
+    for i in range(len(queries)):
+        t0 = time.perf_counter()
+        search(queries[i:i + 1])
+        single.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    found = search(queries)
+    batch_s = time.perf_counter() - t0
+
+    name = rag.index_factory_of(index)
+    return {
+        "index": spec,
+        "factory": f"{name}+rerank{rerank}" if rerank else name,
+        "build_s": build_s,
+        "memory_bytes": _index_bytes(index),
+        "disk_vector_bytes": baseline.ntotal * baseline.d * 4 if rerank else 0,
+        "single_ms": _percentiles_ms(single),
+        "batch_ms_per_query": batch_s * 1000 / len(queries),
+        "batch_qps": len(queries) / batch_s,
+        f"recall@{k}": _recall_at_k(found, truth),
+    }
+
+
+def run(sizes=DEFAULT_SIZES, indexes=DEFAULT_INDEXES, k=10, n_queries=200,
+        corpus_path=None, dim=384, seed=0, rerank=4) -> list[dict]:
+    encoder = HashingEncoder(dim)
+    results = []
+    for size in sizes:
+        t0 = time.perf_counter()
+        texts = load_corpus(corpus_path, size, seed) if corpus_path else generate_corpus(size, seed)
+        query_texts = generate_corpus(n_queries, seed=seed + 1)
+        baseline = rag._new_index(dim, "Flat")
+        for start in range(0, len(texts), 65536):
+            block = texts[start:start + 65536]
+            baseline.add_with_ids(encoder.encode(block), np.arange(start, start + len(block), dtype="int64"))
+        queries = encoder.encode(query_texts)
+        print(f"[bench] {size:,} chunks encoded in {time.perf_counter() - t0:.1f}s")
+
+        _, truth = baseline.search(queries, k)
+        for spec in indexes:
+            row = {"chunks": size, **bench_index(baseline, queries, truth, spec, k, rerank)}
+            print(f"[bench]   {row['factory']:<22} build {row['build_s']:.2f}s, "
+                  f"recall@{k} {row[f'recall@{k}']:.3f}")
+            results.append(row)
+    return results
+
+
+def _keyword_hit_rate(found, words, texts) -> float:
+    hits = total = 0
+    for ids, word in zip(found, words):
+        for i in ids:
+            total += 1
+            hits += word in tokenize(texts[i])
+    return hits / total if total else 0.0
+
+
+def bench_hybrid(texts, baseline, query_texts, queries, words, word_queries, k,
+                 depth=None) -> list[dict]:
+    """Dense-only vs fused retrieval over the same Flat index, as rag does it."""
+    depth = k * (rag.HYBRID_DEPTH if depth is None else depth)
+    t0 = time.perf_counter()
+    builder = BM25Builder()
+    for i, text in enumerate(texts):
+        builder.add(i, text)
+    bm25 = builder.build()
+    build_s = time.perf_counter() - t0
+
+    def search(method, text, vector):
+        if method == "dense":
+            return baseline.search(vector, k)[1][0]
+        distances, ids = baseline.search(vector, depth)
+        scores, lexical_ids = bm25.search(text, depth)
+        return rag.fuse_rankings(ids[0], distances[0], lexical_ids, scores, k, method=method)
+
+    # Methods take turns on every query so clock drift and noisy neighbours
+    # hit them alike; the overhead column compares medians of the same queries
+    single = {method: [] for method in HYBRID_METHODS}
+    for i, text in enumerate(query_texts):
+        for j in range(len(HYBRID_METHODS)):
+            method = HYBRID_METHODS[(i + j) % len(HYBRID_METHODS)]
+            t0 = time.perf_counter()
+            search(method, text, queries[i:i + 1])
+            single[method].append(time.perf_counter() - t0)
+    rows = []
+    for method in HYBRID_METHODS:
+        found = [[i for i in search(method, w, word_queries[j:j + 1]) if i >= 0]
+                 for j, w in enumerate(words)]
+        rows.append({
+            "method": method,
+            "bm25_build_s": build_s,
+            "bm25_bytes": bm25.nbytes,
+            "bm25_terms": bm25.vocab_size,
+            "single_ms": _percentiles_ms(single[method]),
+            f"keyword_hit@{k}": _keyword_hit_rate(found, words, texts),
+        })
+    return rows
+
+
+def run_hybrid(sizes=DEFAULT_SIZES, k=10, n_queries=200, corpus_path=None, dim=384, seed=0) -> list[dict]:
+    encoder = HashingEncoder(dim)
+    results = []
+    for size in sizes:
+        t0 = time.perf_counter()
+        texts = load_corpus(corpus_path, size, seed) if corpus_path else generate_corpus(size, seed)
+        query_texts = generate_corpus(n_queries, seed=seed + 1)
+        baseline = rag._new_index(dim, "Flat")
+        for start in range(0, len(texts), 65536):
+            block = texts[start:start + 65536]
+            baseline.add_with_ids(encoder.encode(block), np.arange(start, start + len(block), dtype="int64"))
+        # One-word queries over the rarer half of the vocabulary: where dense misses keywords
+        vocab = sorted({t for text in texts[:10_000] for t in tokenize(text)})
+        words = [vocab[i] for i in np.random.default_rng(seed).integers(len(vocab) // 2, len(vocab), n_queries)]
+        queries, word_queries = encoder.encode(query_texts), encoder.encode(words)
+        print(f"[bench] {size:,} chunks encoded in {time.perf_counter() - t0:.1f}s")
+        for row in bench_hybrid(texts, baseline, query_texts, queries, words, word_queries, k):
+            results.append({"chunks": size, **row})
+    return results
+
+
+def bench_filtered(baseline, queries, spec, k, selectivities=FILTER_SELECTIVITIES, seed=0) -> list[dict]:
+    """Unfiltered vs selector-filtered vs post-filtered search on one index."""
+    factory = rag.resolve_index_factory(baseline.ntotal, baseline.d, spec)
+    index = baseline if factory == "Flat" else rag.convert_index(baseline, factory)
+    name = rag.index_factory_of(index)
+    store = ChunkStore.empty()   # no kept vectors: rag._search never re-ranks
+    rng = np.random.default_rng(seed)
+    rows = []
+    for selectivity in selectivities:
+        allowed = np.sort(rng.choice(baseline.ntotal, max(int(baseline.ntotal * selectivity), k), replace=False))
+        allow = rag._IdFilter(allowed)
+        _, truth = rag._search(baseline, store, queries, k, allow=allow)
+        fetch = min(int(np.ceil(k / selectivity)), index.ntotal)
+
+        def search(method, q):
+            if method == "unfiltered":
+                return rag._search(index, store, q, k)[1]
+            if method == "selector":
+                return rag._search(index, store, q, k, allow=allow)[1]
+            distances, ids = index.search(q, fetch)
+            return rag._drop_ids(distances, ids, k, allow=allow)[1]
+
+        # Methods take turns on every query, as in bench_hybrid()
+        single = {method: [] for method in FILTER_METHODS}
+        for i in range(len(queries)):
+            for j in range(len(FILTER_METHODS)):
+                method = FILTER_METHODS[(i + j) % len(FILTER_METHODS)]
+                t0 = time.perf_counter()
+                search(method, queries[i:i + 1])
+                single[method].append(time.perf_counter() - t0)
+        for method in FILTER_METHODS:
+            found = search(method, queries)
+            rows.append({
+                "index": name,
+                "selectivity": selectivity,
+                "method": method,
+                "single_ms": _percentiles_ms(single[method]),
+                # Unfiltered results are scored against the filter too: the
+                # share of them a filtered caller could have used
+                f"recall@{k}": _recall_at_k(found, truth),
+            })
+    return rows
+
+
+def run_filtered(sizes=DEFAULT_SIZES, indexes=DEFAULT_INDEXES, k=10, n_queries=200,
+                 corpus_path=None, dim=384, seed=0) -> list[dict]:
+    encoder = HashingEncoder(dim)
+    results = []
+    for size in sizes:
+        t0 = time.perf_counter()
+        texts = load_corpus(corpus_path, size, seed) if corpus_path else generate_corpus(size, seed)
+        query_texts = generate_corpus(n_queries, seed=seed + 1)
+        baseline = rag._new_index(dim, "Flat")
+        for start in range(0, len(texts), 65536):
+            block = texts[start:start + 65536]
+            baseline.add_with_ids(encoder.encode(block), np.arange(start, start + len(block), dtype="int64"))
+        queries = encoder.encode(query_texts)
+        print(f"[bench] {size:,} chunks encoded in {time.perf_counter() - t0:.1f}s")
+        for spec in indexes:
+            for row in bench_filtered(baseline, queries, spec, k, seed=seed):
+                results.append({"chunks": size, **row})
+    return results
+
+
+def format_filtered_table(results: list[dict], k: int = 10) -> str:
+    """One row per (size, index, selectivity, method); "overhead" is p50
+    latency over the unfiltered search of the same index."""
+    header = (f"{'chunks':>9}  {'index':<14} {'filter':>6} {'method':<11} {'p50 ms':>8} "
+              f"{'p95 ms':>8} {'p99 ms':>8} {'overhead':>9} {f'recall@{k}':>9}")
+    lines = [header, "-" * len(header)]
+    base_p50 = {(r["chunks"], r["index"], r["selectivity"]): r["single_ms"]["p50"]
+                for r in results if r["method"] == "unfiltered"}
+    for r in results:
+        base = base_p50.get((r["chunks"], r["index"], r["selectivity"]))
+        overhead = f"{100 * (r['single_ms']['p50'] / base - 1):>+8.1f}%" if base else f"{'-':>9}"
+        lines.append(
+            f"{r['chunks']:>9,}  {r['index']:<14} {r['selectivity']:>6.0%} {r['method']:<11} "
+            f"{r['single_ms']['p50']:>8.3f} {r['single_ms']['p95']:>8.3f} {r['single_ms']['p99']:>8.3f} "
+            f"{overhead} {r[f'recall@{k}']:>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def format_hybrid_table(results: list[dict], k: int = 10) -> str:
+    """One row per (size, method); "overhead" is p50 latency over dense-only."""
+    header = (f"{'chunks':>9}  {'method':<9} {'bm25 build s':>12} {'bm25 MB':>8} {'p50 ms':>8} "
+              f"{'p95 ms':>8} {'p99 ms':>8} {'overhead':>9} {f'kw hit@{k}':>9}")
+    lines = [header, "-" * len(header)]
+    dense_p50 = {r["chunks"]: r["single_ms"]["p50"] for r in results if r["method"] == "dense"}
+    for r in results:
+        base = dense_p50.get(r["chunks"])
+        overhead = f"{100 * (r['single_ms']['p50'] / base - 1):>+8.1f}%" if base else f"{'-':>9}"
+        lines.append(
+            f"{r['chunks']:>9,}  {r['method']:<9} {r['bm25_build_s']:>12.2f} {r['bm25_bytes'] / 1e6:>8.1f} "
+            f"{r['single_ms']['p50']:>8.3f} {r['single_ms']['p95']:>8.3f} {r['single_ms']['p99']:>8.3f} "
+            f"{overhead} {r[f'keyword_hit@{k}']:>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def format_table(results: list[dict], k: int = 10) -> str:
+    """One row per (size, index); "RAM %" is index memory relative to Flat
+    at the same size, "disk MB" the full-precision vectors re-ranking reads."""
+    header = (f"{'chunks':>9}  {'index':<22} {'build s':>8} {'MB':>9} {'RAM %':>6} {'disk MB':>8} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'batch ms/q':>10} {f'recall@{k}':>9}")
+    lines = [header, "-" * len(header)]
+    flat_bytes = {r["chunks"]: r["memory_bytes"] for r in results if r["factory"] == "Flat"}
+    for r in results:
+        base = flat_bytes.get(r["chunks"])
+        ram_pct = f"{100 * r['memory_bytes'] / base:>6.1f}" if base else f"{'-':>6}"
+        lines.append(
+            f"{r['chunks']:>9,}  {r['factory']:<22} {r['build_s']:>8.2f} "
+            f"{r['memory_bytes'] / 1e6:>9.1f} {ram_pct} {r.get('disk_vector_bytes', 0) / 1e6:>8.1f} "
+            f"{r['single_ms']['p50']:>8.3f} {r['single_ms']['p95']:>8.3f} {r['single_ms']['p99']:>8.3f} "
+            f"{r['batch_ms_per_query']:>10.4f} {r[f'recall@{k}']:>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark RoastBot FAISS index types offline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--indexes", nargs="+", default=None,
+                        help="RAG_INDEX_FACTORY values (flat, ivf-flat, ivf-pq, hnsw, sq-fp16, sq8, "
+                             "pq, ivf-sq8 or factory strings), optionally with a +rerank suffix")
+    parser.add_argument("--quantization", action="store_true",
+                        help="Benchmark the compressed storage options (default --indexes otherwise)")
+    parser.add_argument("--hybrid", action="store_true",
+                        help="Benchmark BM25 fusion against dense-only Flat search instead")
+    parser.add_argument("--filtered", action="store_true",
+                        help="Benchmark tag-filtered search against the unfiltered path instead")
+    parser.add_argument("--rerank", type=int, default=4,
+                        help="Candidate multiplier for +rerank specs (like RAG_RERANK)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--corpus", help="Text file to load records from instead of generating them")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--out", default="rag_bench_results",
+                        help="Output path prefix; writes <out>.json and <out>.txt")
+    args = parser.parse_args(argv)
+
+    if args.hybrid:
+        results = run_hybrid(args.sizes, args.k, args.queries, args.corpus, args.dim)
+        table = format_hybrid_table(results, args.k)
+    elif args.filtered:
+        results = run_filtered(args.sizes, args.indexes or list(DEFAULT_INDEXES), args.k, args.queries,
+                               args.corpus, args.dim)
+        table = format_filtered_table(results, args.k)
+    else:
+        indexes = args.indexes or list(QUANTIZATION_INDEXES if args.quantization else DEFAULT_INDEXES)
+        results = run(args.sizes, indexes, args.k, args.queries, args.corpus, args.dim, rerank=args.rerank)
+        table = format_table(results, args.k)
+    print("\n" + table)
+
+    with open(args.out + ".json", "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    with open(args.out + ".txt", "w", encoding="utf-8") as f:
+        f.write(table + "\n")
+    print(f"\nResults written to {args.out}.json and {args.out}.txt")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
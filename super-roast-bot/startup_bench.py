@@ -0,0 +1,244 @@
+"""
+Startup benchmark — startup_bench.py
+
+Measures how long the two entry points take to come up, each in a fresh
+interpreter so nothing is already imported:
+  • import time of `api` and `app`, median of --runs, with a per-package
+    breakdown parsed from `python -X importtime`
+  • which heavy dependencies were pulled in by the import (faiss, numpy,
+    torch, PyPDF2, the LLM SDKs should all be deferred until first use)
+  • time to first successful response: uvicorn serving GET / for api.py,
+    and a complete first script run (streamlit AppTest) for app.py
+  • for api.py, time until /ready reports the RAG index as loaded
+
+Every number is checked against a regression budget (seconds); the script
+exits 1 if any budget is exceeded or a deferred module is imported eagerly,
+so it can gate CI.
+
+Usage:
+  python startup_bench.py
+  RAG_ENCODER=hashing python startup_bench.py --runs 5 --out startup_results
+  python startup_bench.py --budget api.import_s=0.5 --skip-serve
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds; generous enough for a cold laptop, tight enough to catch an eager
+# `import faiss` / `import openai` sneaking back into the import path
+DEFAULT_BUDGETS = {
+    "api.import_s": 1.0,
+    "app.import_s": 2.5,
+    "api.first_response_s": 3.0,
+    "app.first_render_s": 5.0,
+}
+
+# Modules that must not be imported just by importing the entry point
+DEFERRED_MODULES = {
+    "api": ("faiss", "numpy", "torch", "sentence_transformers", "PyPDF2", "openai"),
+    "app": ("PyPDF2", "groq"),
+}
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+# ── Import time ───────────────────────────────────────────────────────────────
+
+def _run_python(code: str, *flags: str, timeout: float = 120) -> subprocess.CompletedProcess:
+    env = {**os.environ, "PYTHONPATH": HERE + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=HERE, env=env, capture_output=True, text=True, timeout=timeout,
+    )
+
+
+def measure_import(module: str) -> dict:
+    """Wall time of `import module` in a fresh interpreter, plus deferred-module leaks."""
+    code = (
+        "import sys, time, json\n"
+        "t0 = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - t0\n"
+        f"watch = {list(DEFERRED_MODULES.get(module, ()))!r}\n"
+        "print(json.dumps({'seconds': elapsed, 'leaked': [m for m in watch if m in sys.modules]}))\n"
+    )
+    proc = _run_python(code)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def import_breakdown(module: str, top: int = 12) -> list[dict]:
+    """Self time of everything imported by `module`, summed per top-level package."""
+    proc = _run_python(f"import {module}", "-X", "importtime")
+    per_package: dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if m:
+            package = m.group(4).split(".")[0]
+            per_package[package] = per_package.get(package, 0) + int(m.group(1))
+    rows = sorted(per_package.items(), key=lambda kv: kv[1], reverse=True)[:top]
+    return [{"package": name, "self_ms": us / 1000} for name, us in rows]
+
+
+# ── Time to first response ────────────────────────────────────────────────────
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _poll(url: str, deadline: float) -> bool:
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def measure_api_serve(timeout: float = 120) -> dict:
+    """Spawn uvicorn; time until GET / succeeds and until GET /ready returns 200."""
+    port = _free_port()
+    env = {**os.environ, "PYTHONPATH": HERE + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        deadline = t0 + timeout
+        first = time.perf_counter() - t0 if _poll(base + "/", deadline) else None
+        ready = time.perf_counter() - t0 if _poll(base + "/ready", deadline) else None
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {"first_response_s": first, "ready_s": ready}
+
+
+def measure_app_render(timeout: float = 120) -> dict:
+    """Run app.py once through streamlit's AppTest in a fresh interpreter."""
+    code = (
+        "import time, json\n"
+        "from streamlit.testing.v1 import AppTest\n"
+        f"at = AppTest.from_file('app.py', default_timeout={timeout}).run()\n"
+        "print(json.dumps({'exceptions': [str(e.value) for e in at.exception]}))\n"
+    )
+    t0 = time.perf_counter()
+    proc = _run_python(code, timeout=timeout)
+    elapsed = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"app.py first render failed:\n{proc.stderr[-2000:]}")
+    errors = json.loads(proc.stdout.strip().splitlines()[-1])["exceptions"]
+    return {"first_render_s": None if errors else elapsed, "errors": errors}
+
+
+# ── Driver ────────────────────────────────────────────────────────────────────
+
+def run(runs: int = 3, serve: bool = True) -> dict:
+    results = {}
+    for module in ("api", "app"):
+        samples = [measure_import(module) for _ in range(runs)]
+        results[module] = {
+            "import_s": statistics.median(s["seconds"] for s in samples),
+            "leaked": sorted({m for s in samples for m in s["leaked"]}),
+            "breakdown": import_breakdown(module),
+        }
+        print(f"[startup] import {module}: {results[module]['import_s'] * 1000:.0f} ms (median of {runs})")
+    if serve:
+        results["api"].update(measure_api_serve())
+        print(f"[startup] api first response {results['api']['first_response_s']}, "
+              f"ready {results['api']['ready_s']}")
+        results["app"].update(measure_app_render())
+        print(f"[startup] app first render {results['app']['first_render_s']}")
+    return results
+
+
+def check_budgets(results: dict, budgets: dict) -> list[str]:
+    """Return one message per violated budget or eagerly imported module."""
+    failures = []
+    for key, limit in budgets.items():
+        module, metric = key.split(".", 1)
+        if metric not in results.get(module, {}):
+            continue
+        value = results[module][metric]
+        if value is None:
+            failures.append(f"{key}: never succeeded")
+        elif value > limit:
+            failures.append(f"{key}: {value:.3f}s > budget {limit:.3f}s")
+    for module, data in results.items():
+        if data.get("leaked"):
+            failures.append(f"{module}: imports {', '.join(data['leaked'])} eagerly")
+    return failures
+
+
+def format_report(results: dict, budgets: dict) -> str:
+    lines = []
+    for module, data in results.items():
+        lines.append(f"{module}.py")
+        for metric in ("import_s", "first_response_s", "ready_s", "first_render_s"):
+            if metric in data:
+                value = data[metric]
+                budget = budgets.get(f"{module}.{metric}")
+                shown = "failed" if value is None else f"{value * 1000:8.0f} ms"
+                limit = f"  (budget {budget * 1000:.0f} ms)" if budget else ""
+                lines.append(f"  {metric:<18} {shown}{limit}")
+        lines.append("  slowest packages (self time, -X importtime):")
+        for row in data["breakdown"]:
+            lines.append(f"    {row['package']:<28} {row['self_ms']:8.1f} ms")
+    return "\n".join(lines)
+
+
+def _parse_budget(text: str) -> tuple[str, float]:
+    key, _, value = text.partition("=")
+    if key not in DEFAULT_BUDGETS or not value:
+        raise argparse.ArgumentTypeError(f"expected one of {sorted(DEFAULT_BUDGETS)}=SECONDS")
+    return key, float(value)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark RoastBot import and startup time.")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh-interpreter imports per entry point")
+    parser.add_argument("--budget", type=_parse_budget, action="append", default=[],
+                        help="Override a budget, e.g. api.import_s=0.5 (repeatable)")
+    parser.add_argument("--skip-serve", action="store_true",
+                        help="Only measure imports (no uvicorn / AppTest run)")
+    parser.add_argument("--out", help="Write <out>.json with the raw results")
+    args = parser.parse_args(argv)
+
+    budgets = {**DEFAULT_BUDGETS, **dict(args.budget)}
+    results = run(args.runs, serve=not args.skip_serve)
+    print("\n" + format_report(results, budgets))
+
+    if args.out:
+        with open(args.out + ".json", "w", encoding="utf-8") as f:
+            json.dump({"results": results, "budgets": budgets}, f, indent=2)
+
+    failures = check_budgets(results, budgets)
+    for failure in failures:
+        print(f"[startup] REGRESSION {failure}")
+    if not failures:
+        print("\n[startup] all startup budgets met")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
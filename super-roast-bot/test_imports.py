@@ -35,6 +35,14 @@ try:
 except ImportError as e:
     print(f"✗ database.py import failed: {e}")
 
+# Heavy dependencies are deferred until retrieval / the first LLM call
+import rag  # noqa: E402
+eager = [m for m in ("faiss", "numpy", "PyPDF2", "torch", "sentence_transformers") if m in sys.modules]
+if eager:
+    print(f"✗ importing rag pulled in {', '.join(eager)} eagerly")
+else:
+    print("✓ rag.py imports without faiss/numpy/PyPDF2/torch")
+
 print("\n✓ All core modules import successfully!")
 
 # Quick functional test
@@ -0,0 +1,208 @@
+"""
+Incremental Refresh Test Suite for RoastBot RAG Module
+Adds, changes and deletes data files under every index type and checks that
+the index, chunk store, BM25 index and ledger stay in step
+"""
+
+import sys
+import os
+import tempfile
+
+# rag reads these at import time; keep the test away from the real data/ and cache
+_TMP = tempfile.mkdtemp(prefix="roastbot-refresh-")
+os.environ["RAG_DATA_DIR"] = os.path.join(_TMP, "data")
+os.environ["RAG_CACHE_DIR"] = os.path.join(_TMP, "cache")
+os.environ.setdefault("RAG_ENCODER", "hashing")
+os.environ.setdefault("RAG_PROGRESS_INTERVAL", "0")
+# One paragraph per chunk, so there are enough vectors to train IVF and PQ
+os.environ.setdefault("RAG_CHUNK_SIZE", "40")
+
+import numpy as np
+import rag
+from embeddings import get_encoder
+
+FACTORIES = ["Flat", "SQfp16", "PQ8", "HNSW32", "IVF16,Flat", "IVF16,SQ8", "IVF16,PQ8"]
+TOPICS = ["python", "javascript", "rust", "golang", "java", "kotlin", "haskell", "cobol"]
+
+
+def _write(name, text):
+    path = os.path.join(rag.DATA_FOLDER, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    # mtime resolution can hide a rewrite within the same second
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+
+
+def _file_text(topic, n, variant=""):
+    return "\n\n".join(
+        f"Roast {i} {variant}for {topic} developer number {i * 7919 % 1000}: your {topic} code "
+        f"compiles {i} times slower than a {topic} tutorial from {1990 + i % 30}."
+        for i in range(n))
+
+
+def _reset_data():
+    for root, _, names in os.walk(rag.DATA_FOLDER):
+        for name in names:
+            os.remove(os.path.join(root, name))
+    for topic in TOPICS:
+        _write(f"{topic}.txt", _file_text(topic, 60))
+
+
+def _ids_of(ledger, filename):
+    return set(ledger["files"][filename]["ids"])
+
+
+def _check_consistent(index, chunks, lexical, ledger):
+    """Return a list of problems (empty when index, stores and ledger agree)."""
+    problems = []
+    if not index.ntotal == len(chunks) == len(lexical):
+        problems.append(f"sizes differ: index {index.ntotal}, chunks {len(chunks)}, bm25 {len(lexical)}")
+    index_ids = set(rag._index_ids(index).tolist())
+    chunk_ids = set(chunks)
+    ledger_ids = {i for entry in ledger["files"].values() for i in entry["ids"]}
+    if index_ids != chunk_ids:
+        problems.append(f"index and chunk store ids differ by {len(index_ids ^ chunk_ids)}")
+    if ledger_ids != chunk_ids:
+        problems.append(f"ledger and chunk store ids differ by {len(ledger_ids ^ chunk_ids)}")
+    return problems
+
+
+def _top_ids(index, chunks, encoder, text, k=5):
+    _, ids = rag._search(index, chunks, rag._embed([text], encoder), k)
+    return [int(i) for i in ids[0] if i >= 0]
+
+
+def _check_refresh(factory, encoder):
+    """Build, convert to factory, then add/change/delete files and refresh."""
+    _reset_data()
+    index, chunks, lexical, ledger, _, _ = rag._build_fresh(encoder, {})
+    index = rag.convert_index(index, factory)
+    problems = _check_consistent(index, chunks, lexical, ledger)
+
+    deleted_ids = _ids_of(ledger, "cobol.txt")
+    old_rust_ids = _ids_of(ledger, "rust.txt")
+    os.remove(os.path.join(rag.DATA_FOLDER, "cobol.txt"))
+    _write("rust.txt", _file_text("rust", 40, variant="reloaded "))
+    _write("extra/zig.txt", _file_text("zig", 30))
+
+    index, chunks, lexical, report = rag._apply_refresh(index, chunks, lexical, ledger, encoder, copy=True)
+    files = report["files"]
+    if (files["added"], files["updated"], files["removed"]) != (1, 1, 1):
+        problems.append(f"ledger bookkeeping: {files}")
+    if "cobol.txt" in ledger["files"] or "extra/zig.txt" not in ledger["files"]:
+        problems.append("ledger still lists the deleted file or misses the new one")
+    problems += _check_consistent(index, chunks, lexical, ledger)
+    if deleted_ids & set(chunks) or old_rust_ids & set(chunks):
+        problems.append("chunks of deleted or replaced content survived the refresh")
+
+    # Every remaining chunk must still be searchable under its own text
+    rag._enable_reconstruct(index)
+    ids = np.fromiter(chunks, dtype="int64", count=len(chunks))
+    vectors = index.reconstruct_batch(ids)
+    if vectors.shape != (len(ids), index.d):
+        problems.append(f"reconstruct_batch returned {vectors.shape}")
+    for filename in ("extra/zig.txt", "rust.txt", "python.txt"):
+        probe = sorted(_ids_of(ledger, filename))[3]
+        hits = _top_ids(index, chunks, encoder, chunks.text(probe))
+        if probe not in hits:
+            problems.append(f"{filename}: chunk {probe} not in its own top 5 ({hits})")
+        if any(h not in chunks for h in hits):
+            problems.append(f"{filename}: search returned ids missing from the chunk store")
+
+    # Persist, reload (a restart) and refresh again on top of the reloaded copy
+    manifest = {"test_factory": factory}
+    if not rag.save_cached_index(index, chunks, lexical, ledger, manifest):
+        problems.append("save_cached_index failed")
+    cached = rag.load_cached_index(manifest)
+    if cached is None:
+        problems.append("cache did not load back")
+    else:
+        index, chunks, lexical, ledger, _ = cached
+        os.remove(os.path.join(rag.DATA_FOLDER, "java.txt"))
+        index, chunks, lexical, _ = rag._apply_refresh(index, chunks, lexical, ledger, encoder, copy=True)
+        problems += _check_consistent(index, chunks, lexical, ledger)
+        probe = sorted(_ids_of(ledger, "kotlin.txt"))[5]
+        if probe not in _top_ids(index, chunks, encoder, chunks.text(probe)):
+            problems.append(f"after reload: chunk {probe} not in its own top 5")
+    return problems
+
+
+def test_refresh_all_index_types():
+    """Refresh keeps every index type consistent with the chunk store and ledger."""
+    print("\n[TEST 1] Incremental Refresh Per Index Type")
+    print("=" * 60)
+
+    encoder = get_encoder()
+    failed = []
+    for factory in FACTORIES:
+        problems = _check_refresh(factory, encoder)
+        status = "[OK]" if not problems else "[FAIL]"
+        print(f"{status} {factory}")
+        for problem in problems:
+            print(f"   - {problem}")
+        if problems:
+            failed.append(factory)
+
+    if failed:
+        print(f"\n[FAILED]: {', '.join(failed)}")
+        return False
+    print(f"\n[PASSED]: {len(FACTORIES)} index types refreshed consistently")
+    return True
+
+
+def test_no_op_refresh():
+    """A refresh with nothing changed keeps the very same objects."""
+    print("\n[TEST 2] No-Op Refresh")
+    print("=" * 60)
+
+    encoder = get_encoder()
+    _reset_data()
+    index, chunks, lexical, ledger, _, _ = rag._build_fresh(encoder, {})
+    new_index, new_chunks, new_lexical, report = rag._apply_refresh(
+        index, chunks, lexical, ledger, encoder, copy=True)
+    files = report["files"]
+    print(f"   Files: {files}")
+    if new_index is not index or new_chunks is not chunks or new_lexical is not lexical:
+        print("\n[FAILED]: unchanged data/ still produced new objects")
+        return False
+    if files["added"] or files["updated"] or files["removed"] or files["unchanged"] != len(TOPICS):
+        print("\n[FAILED]: unchanged files were reported as changed")
+        return False
+    print("\n[PASSED]: Nothing copied or re-embedded")
+    return True
+
+
+def run_all_tests():
+    """Run all refresh tests."""
+    print("\n" + "=" * 60)
+    print("ROASTBOT RAG REFRESH TEST SUITE")
+    print("=" * 60)
+
+    tests = [
+        test_refresh_all_index_types,
+        test_no_op_refresh,
+    ]
+
+    results = []
+    for test in tests:
+        try:
+            results.append(test())
+        except Exception as e:
+            print(f"\n[CRASHED] Test crashed: {type(e).__name__}: {e}")
+            results.append(False)
+
+    print("\n" + "=" * 60)
+    print("TEST SUMMARY")
+    print("=" * 60)
+    for i, (test, result) in enumerate(zip(tests, results), 1):
+        print(f"{'[PASS]' if result else '[FAIL]'} - Test {i}: {test.__name__}")
+    passed, total = sum(results), len(results)
+    print(f"\nFinal Score: {passed}/{total} tests passed")
+    return passed == total
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
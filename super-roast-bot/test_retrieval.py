@@ -0,0 +1,314 @@
+"""
+Retrieval Behaviour Test Suite for RoastBot RAG Module
+Checks the chunker, BM25, near-duplicate filter, tag/mode filters, caches,
+context packing, query segmentation and the data folder ledger scan
+"""
+
+import sys
+import os
+import random
+import tempfile
+import time
+
+# rag reads these at import time; keep the test away from the real data/ and cache
+_TMP = tempfile.mkdtemp(prefix="roastbot-retrieval-")
+os.environ["RAG_DATA_DIR"] = os.path.join(_TMP, "data")
+os.environ["RAG_CACHE_DIR"] = os.path.join(_TMP, "cache")
+os.environ.setdefault("RAG_ENCODER", "hashing")
+os.environ.setdefault("RAG_PROGRESS_INTERVAL", "0")
+os.environ.setdefault("RAG_CHUNK_SIZE", "200")
+
+import numpy as np
+import rag
+from dedup import NearDuplicateFilter, minhash
+from lexical import build_bm25
+
+WORDS = "roast code bug python slow java null pointer deploy friday coffee merge".split()
+
+
+def _write(name, text):
+    path = os.path.join(rag.DATA_FOLDER, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    # mtime resolution can hide a rewrite within the same second
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+
+
+def _corpus(records, seed=3):
+    rng = random.Random(seed)
+    return "\n\n".join(
+        "\n".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))) + "."
+                  for _ in range(rng.randint(1, 5)))
+        for _ in range(records))
+
+
+def _report(problems, passed):
+    for problem in problems:
+        print(f"   - {problem}")
+    if problems:
+        print("\n[FAILED]")
+        return False
+    print(f"\n[PASSED]: {passed}")
+    return True
+
+
+def test_chunker():
+    """Chunks stay within the size limit, overlap, and streaming matches chunk_text()."""
+    print("\n[TEST 1] Chunker")
+    print("=" * 60)
+
+    problems = []
+    text = _corpus(1500)   # well over TEXT_BLOCK_CHARS, so streaming cuts it
+    for unit, size, overlap in (("chars", 300, 80), ("tokens", 60, 15), ("chars", 500, 0)):
+        settings = dict(chunk_size=size, overlap=overlap, unit=unit)
+        whole = rag.chunk_text(text, **settings)
+        blocks = [(None, text[i:i + 5000]) for i in range(0, len(text), 5000)]
+        streamed = list(rag._iter_document_chunks("f.txt", blocks, **settings))
+        print(f"   {unit}/{size}/{overlap}: {len(whole)} chunks, {len(streamed)} streamed")
+        if [(c.start, c.end, c.text) for c in streamed] != [(c.start, c.end, c.text) for c in whole]:
+            problems.append(f"{unit}: streamed chunks differ from chunk_text()")
+        if any(text[c.start:c.end] != c.text for c in whole):
+            problems.append(f"{unit}: chunk text does not match its span")
+        if unit == "chars" and max(len(c.text) for c in whole) > size:
+            problems.append(f"chars: chunk of {max(len(c.text) for c in whole)} > {size}")
+        shared = sum(b.start < a.end for a, b in zip(whole, whole[1:]))
+        if overlap and not shared:
+            problems.append(f"{unit}: no consecutive chunks overlap")
+        if not overlap and shared:
+            problems.append(f"{unit}: {shared} chunks overlap with overlap=0")
+
+    doc = "---\ntags: Office, dry humor\n---\nYour standup is a sitdown.\n\nYour sprint is a crawl."
+    chunks = list(rag._iter_document_chunks("work/meetings.txt", [(None, doc)]))
+    if any("tags:" in c.text for c in chunks):
+        problems.append("front matter was chunked")
+    if set(chunks[0].tags) != {"work", "meetings", "office", "dry-humor"}:
+        problems.append(f"tags from path and front matter: {chunks[0].tags}")
+    return _report(problems, "chunks bounded, overlapping and identical when streamed")
+
+
+def test_bm25():
+    """BM25 ranks keyword matches first and honours allow/exclude."""
+    print("\n[TEST 2] BM25 Keyword Search")
+    print("=" * 60)
+
+    texts = [
+        "your kubernetes cluster has more pods than users",
+        "your python code is slow",
+        "your java code is verbose",
+        "your python tests are flaky and your python linter gave up",
+    ]
+    chunks = [rag.Chunk(id=i + 10, text=t, source="t.txt", page=None, start=0, end=len(t),
+                        token_count=len(t.split())) for i, t in enumerate(texts)]
+    index = build_bm25(chunks)
+    problems = []
+    _, ids = index.search("kubernetes", 3)
+    if ids.tolist() != [10]:
+        problems.append(f"rare term: {ids.tolist()}")
+    _, ids = index.search("python", 3)
+    if ids.tolist() != [13, 11]:
+        problems.append(f"term frequency ranking: {ids.tolist()}")
+    _, ids = index.search("haskell monads", 3)
+    if len(ids):
+        problems.append("documents without any query term were returned")
+    _, ids = index.search("python", 3, exclude=np.array([13]))
+    if ids.tolist() != [11]:
+        problems.append(f"exclude: {ids.tolist()}")
+    _, ids = index.search("code", 3, allow=np.array([12]))
+    if ids.tolist() != [12]:
+        problems.append(f"allow: {ids.tolist()}")
+    return _report(problems, "BM25 ranking and id restrictions")
+
+
+def test_dedup():
+    """Near duplicates are dropped, wordless chunks are not, seeds are searched."""
+    print("\n[TEST 3] Near-Duplicate Filter")
+    print("=" * 60)
+
+    rng = random.Random(7)
+    problems = []
+    base = [" ".join(rng.choice(WORDS) + str(rng.randint(0, 999)) for _ in range(40)) for _ in range(3000)]
+    f = NearDuplicateFilter(0.8)
+    for i, text in enumerate(base):
+        f.check(i, text)
+    if f.removed:
+        problems.append(f"{f.removed} distinct texts reported as duplicates")
+    # One word appended: over 0.8 Jaccard. Checked after several
+    # buffer flushes, so merged runs are searched too
+    _, dup = f.check(10_000, base[5] + " extra")
+    if dup != 5:
+        problems.append(f"near duplicate of chunk 5 matched {dup}")
+    _, dup = f.check(10_001, "🔥🔥🔥")
+    _, dup2 = f.check(10_002, "💀💀")
+    if dup is not None or dup2 is not None:
+        problems.append("wordless chunks were treated as duplicates of each other")
+
+    seeded = NearDuplicateFilter(0.8, seed_signatures=np.stack([minhash(t) for t in base[:50]]),
+                                 seed_ids=list(range(100, 150)))
+    _, dup = seeded.check(1, base[20] + " extra")
+    if dup != 120:
+        problems.append(f"seeded duplicate matched {dup}")
+    ignoring = NearDuplicateFilter(0.8, seed_signatures=np.stack([minhash(t) for t in base[:50]]),
+                                   seed_ids=list(range(100, 150)), ignore_ids={120})
+    _, dup = ignoring.check(1, base[20] + " extra")
+    if dup is not None:
+        problems.append("ignored seed id still matched")
+    print(f"   Checked {f.checked}, removed {f.removed}")
+    return _report(problems, "duplicates dropped, distinct and wordless chunks kept")
+
+
+def test_filters_and_caches():
+    """Tag and mode filters restrict search; repeated queries hit the caches."""
+    print("\n[TEST 4] Filters And Caches")
+    print("=" * 60)
+
+    _write("office/meetings.txt", "---\ntags: dry humor\n---\n" + "\n\n".join(
+        f"Your meeting {i} could have been an email about the quarterly roadmap." for i in range(20)))
+    _write("savage/code.txt", "\n\n".join(
+        f"Your code review {i} is a crime scene and the roadmap is a ransom note." for i in range(20)))
+    _write("general.txt", "\n\n".join(
+        f"Your roadmap {i} has more pivots than a basketball game." for i in range(20)))
+    problems = []
+    rag.warmup()
+
+    sources = {r.source for r in rag.search("roadmap", top_k=10, tags=["office"])}
+    if sources != {"office/meetings.txt"}:
+        problems.append(f"tags=['office'] returned {sources}")
+    sources = {r.source for r in rag.search("roadmap", top_k=10, tags=["Dry Humor"])}
+    if sources != {"office/meetings.txt"}:
+        problems.append(f"front matter tag returned {sources}")
+    sources = {r.source for r in rag.search("roadmap", top_k=60, mode="Professional 💼")}
+    if "savage/code.txt" in sources or not sources:
+        problems.append(f"mode filter kept {sources}")
+    if rag.search("roadmap", tags=["no-such-tag"]):
+        problems.append("unknown tag matched chunks")
+
+    stats = rag.cache_stats()["result_cache"]
+    first = rag.search("  quarterly   roadmap ", top_k=3)
+    second = rag.search("quarterly roadmap", top_k=3)
+    after = rag.cache_stats()["result_cache"]
+    if after["hits"] != stats["hits"] + 1:
+        problems.append("normalized repeat query missed the result cache")
+    if [r.chunk_id for r in first] != [r.chunk_id for r in second]:
+        problems.append("cached results differ from the first search")
+
+    cache = rag._LRUCache(2, ttl=0.05)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    if cache.get("b") is not None or cache.get("a") != 1:
+        problems.append("LRU evicted the recently used entry")
+    time.sleep(0.1)
+    if cache.get("a") is not None or cache.stats()["expirations"] != 1:
+        problems.append("TTL entry did not expire")
+    return _report(problems, "filters restrict results, caches hit, evict and expire")
+
+
+def test_pack_results():
+    """pack_results() keeps the best results that fit the token budget."""
+    print("\n[TEST 5] Context Packing")
+    print("=" * 60)
+
+    results = [rag.SearchResult(i, 1.0 - i / 10, "t.txt", None, n, (), _chunks=None)
+               for i, n in enumerate([50, 80, 30, 10])]
+    packed = [r.chunk_id for r in rag.pack_results(results, 100)]
+    print(f"   Packed ids: {packed}")
+    # 50 + sep + 30 = 81 (80 is skipped), + sep + 10 = 92
+    problems = [] if packed == [0, 2, 3] else [f"packed {packed}, expected [0, 2, 3]"]
+    if rag.pack_results(results, 5):
+        problems.append("a budget smaller than every result still packed one")
+    return _report(problems, "budget respected, smaller results fill the gaps")
+
+
+def test_query_segments():
+    """Long queries are split into segments within QUERY_SEGMENT_TOKENS."""
+    print("\n[TEST 6] Query Segmentation")
+    print("=" * 60)
+
+    problems = []
+    short = "why is my python slow"
+    if rag._query_segments(short) != [short]:
+        problems.append("short query was split")
+    long_query = ". ".join(" ".join(WORDS[(i + j) % len(WORDS)] for j in range(12)) for i in range(80))
+    segments = rag._query_segments(long_query)
+    sizes = [rag.count_tokens(s) for s in segments]
+    print(f"   {len(segments)} segments, largest {max(sizes)} tokens")
+    if len(segments) < 2:
+        problems.append("long query was not split")
+    if max(sizes) > rag.QUERY_SEGMENT_TOKENS * 1.1:
+        problems.append(f"segment of {max(sizes)} tokens")
+    if " ".join(" ".join(segments).split()) != " ".join(long_query.split()):
+        problems.append("segments do not cover the query")
+    return _report(problems, "segments bounded and covering the query")
+
+
+def test_ledger_scan():
+    """The data folder scan reports new, changed, touched and removed files."""
+    print("\n[TEST 7] Ledger Scan")
+    print("=" * 60)
+
+    _write("scan/kept.txt", "kept roast")
+    _write("scan/touched.txt", "touched roast")
+    _write("scan/edited.txt", "edited roast")
+    ledger = {"files": {}}
+    changed, removed, unchanged = rag._scan_data_folder(ledger)
+    ledger["files"] = dict(unchanged, **{f: dict(e, ids=[]) for f, e, _ in changed})
+    problems = []
+    if not all(is_new for _, _, is_new in changed):
+        problems.append("first scan reported known files")
+
+    _write("scan/touched.txt", "touched roast")
+    _write("scan/edited.txt", "edited roast, now with more burn")
+    _write("scan/new.txt", "new roast")
+    os.remove(os.path.join(rag.DATA_FOLDER, "scan/kept.txt"))
+    changed, removed, unchanged = rag._scan_data_folder(ledger)
+    changed = {f: is_new for f, _, is_new in changed}
+    print(f"   changed {changed}, removed {removed}")
+    if changed.get("scan/edited.txt") is not False or changed.get("scan/new.txt") is not True:
+        problems.append(f"changed files: {changed}")
+    if "scan/touched.txt" in changed or "scan/touched.txt" not in unchanged:
+        problems.append("a touched but identical file was reported as changed")
+    if removed != ["scan/kept.txt"]:
+        problems.append(f"removed files: {removed}")
+    return _report(problems, "new, changed, touched and removed files told apart")
+
+
+def run_all_tests():
+    """Run all retrieval behaviour tests."""
+    print("\n" + "=" * 60)
+    print("ROASTBOT RAG RETRIEVAL TEST SUITE")
+    print("=" * 60)
+
+    tests = [
+        test_chunker,
+        test_bm25,
+        test_dedup,
+        test_filters_and_caches,
+        test_pack_results,
+        test_query_segments,
+        test_ledger_scan,
+    ]
+
+    results = []
+    for test in tests:
+        try:
+            results.append(test())
+        except Exception as e:
+            print(f"\n[CRASHED] Test crashed: {type(e).__name__}: {e}")
+            results.append(False)
+
+    print("\n" + "=" * 60)
+    print("TEST SUMMARY")
+    print("=" * 60)
+    for i, (test, result) in enumerate(zip(tests, results), 1):
+        print(f"{'[PASS]' if result else '[FAIL]'} - Test {i}: {test.__name__}")
+    passed, total = sum(results), len(results)
+    print(f"\nFinal Score: {passed}/{total} tests passed")
+    return passed == total
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -9,6 +9,7 @@ import os
 import concurrent.futures
 import threading
 import time
+import rag
 from rag import retrieve_context
 
 def test_concurrent_retrieval():
@@ -168,6 +169,168 @@ def test_thread_safety_stress():
         return False
 
 
+def _percentile(sorted_values, pct):
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _measure_retrieval(num_callers, queries_per_caller):
+    """Return (throughput q/s, p50 ms, p99 ms, errors) for num_callers concurrent callers."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(num_callers)
+
+    def caller(caller_id):
+        start_barrier.wait()
+        for i in range(queries_per_caller):
+            query = f"roast my code {caller_id} {i}"
+            t0 = time.perf_counter()
+            try:
+                result = retrieve_context(query, top_k=1)
+                if not result:
+                    raise ValueError("empty result")
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(num_callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors
+    return (
+        len(latencies) / elapsed,
+        _percentile(latencies, 50) * 1000,
+        _percentile(latencies, 99) * 1000,
+        errors,
+    )
+
+
+def test_query_batching_benchmark():
+    """Compare the micro-batching query encoder with the old per-query lock."""
+    print("\n[TEST 4] Query Encoder Batching Benchmark")
+    print("=" * 60)
+
+    retrieve_context("warm up", top_k=1)
+    original_mode = rag.QUERY_BATCHING
+    # Disable the retrieval caches so every query really hits the encoder
+    caches = (rag._embedding_cache, rag._result_cache)
+    original_sizes = [c.maxsize for c in caches]
+    for c in caches:
+        c.clear()
+        c.maxsize = 0
+    all_errors = []
+    rows = []
+    try:
+        for num_callers in (1, 8, 32, 128):
+            queries_per_caller = max(2, 256 // num_callers)
+            for mode, batching in (("lock", False), ("batched", True)):
+                rag.QUERY_BATCHING = batching
+                qps, p50, p99, errors = _measure_retrieval(num_callers, queries_per_caller)
+                all_errors.extend(errors)
+                rows.append((num_callers, mode, qps, p50, p99))
+    finally:
+        rag.QUERY_BATCHING = original_mode
+        for c, size in zip(caches, original_sizes):
+            c.maxsize = size
+
+    print(f"\n   {'callers':>7}  {'mode':<8} {'q/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for num_callers, mode, qps, p50, p99 in rows:
+        print(f"   {num_callers:>7}  {mode:<8} {qps:>9.1f} {p50:>9.2f} {p99:>9.2f}")
+
+    if all_errors:
+        print(f"\n[FAILED]: {len(all_errors)} errors occurred")
+        for error in all_errors[:5]:
+            print(f"   - {error}")
+        return False
+    print("\n[PASSED]: Both encoder paths served every query")
+    return True
+
+
+def test_hot_swap_rebuild():
+    """Readers keep getting results while a full rebuild is built and swapped in."""
+    print("\n[TEST 5] Hot-Swap Rebuild Under Load")
+    print("=" * 60)
+
+    retrieve_context("warm up", top_k=1)
+    version_before = rag.rebuild_status()["live_version"]
+    stop = threading.Event()
+    errors = []
+    latencies = []
+    lock = threading.Lock()
+
+    # Like an HF fast tokenizer, fail when two threads are inside the model at once
+    encoder = rag._global_encoder
+    encode = encoder.encode
+    inside = threading.Lock()
+
+    def exclusive_encode(texts, **kwargs):
+        if not inside.acquire(blocking=False):
+            raise RuntimeError("Already borrowed")
+        try:
+            time.sleep(0.001)
+            return encode(texts, **kwargs)
+        finally:
+            inside.release()
+
+    encoder.encode = exclusive_encode
+
+    def reader(reader_id):
+        i = 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                if not retrieve_context(f"roast my bugs {reader_id} {i}", top_k=1):
+                    raise ValueError("empty result during rebuild")
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    status = rag.rebuild(full=True, background=True)
+    started = status["started"]
+    while rag.rebuild_status()["state"] == "running":
+        time.sleep(0.01)
+    time.sleep(0.05)   # some reads on the new snapshot too
+    stop.set()
+    for t in threads:
+        t.join()
+    del encoder.encode
+    status = rag.rebuild_status()
+
+    latencies.sort()
+    print(f"   Rebuild: {status['state']} in {status.get('duration_s', 0):.2f}s, "
+          f"version {version_before} -> {status['live_version']}")
+    print(f"   Reads during rebuild: {len(latencies)}, "
+          f"p99 {_percentile(latencies, 99) * 1000:.2f} ms" if latencies else "   No reads completed")
+
+    if not started or status["state"] != "done" or status["live_version"] != version_before + 1:
+        print(f"\n[FAILED]: rebuild did not publish a new snapshot: {status}")
+        return False
+    if errors:
+        print(f"\n[FAILED]: {len(errors)} errors occurred")
+        for error in errors[:5]:
+            print(f"   - {error}")
+        return False
+    print("\n[PASSED]: New snapshot published without failing a single read")
+    return True
+
+
 def run_all_tests():
     """Run all thread-safety tests."""
     print("\n" + "=" * 60)
@@ -178,6 +341,8 @@ def run_all_tests():
         test_concurrent_retrieval,
         test_rapid_sequential_access,
         test_thread_safety_stress,
+        test_query_batching_benchmark,
+        test_hot_swap_rebuild,
     ]
     
     results = []
@@ -0,0 +1,41 @@
+"""
+Atomic file replacement — utils/atomic_files.py
+
+Cache files (FAISS index, chunk store, BM25 index, manifest) are written to a
+temp file in the same directory and os.replace()d into place, so readers
+never see a half-written file. Temp names are unique per call, so several
+processes writing the same cache can't rename each other's files away:
+
+    tmp = temp_path_for(path)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        discard([tmp])
+        raise
+"""
+
+from __future__ import annotations
+
+import os
+import tempfile
+from typing import Iterable
+
+
+def temp_path_for(path: str) -> str:
+    """Create an empty, uniquely named file next to path and return its name."""
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+    os.close(fd)
+    # mkstemp creates 0600; cache files are read by other workers and users
+    os.chmod(tmp, 0o644)
+    return tmp
+
+
+def discard(paths: Iterable[str]) -> None:
+    """Best-effort removal of leftover temp files."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
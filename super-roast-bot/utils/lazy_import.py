@@ -0,0 +1,60 @@
+"""
+Deferred imports — utils/lazy_import.py
+
+faiss, numpy and friends cost hundreds of milliseconds to import. Modules that
+only need them on the retrieval path bind a LazyModule instead, so importing
+them (and everything that imports them, e.g. api.py) stays cheap:
+
+    np = lazy_module("numpy")      # nothing imported yet
+    np.zeros(3)                    # numpy imported here, once
+
+Attribute access is the only trigger; the real module is cached after the
+first access, so later lookups cost one extra dict hit.
+"""
+
+from __future__ import annotations
+
+import importlib
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module stand-in that imports the real module on first attribute access."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+        self.__dict__["_lazy_lock"] = threading.Lock()
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with self.__dict__["_lazy_lock"]:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.__dict__["_lazy_module"] is not None
+
+    def __getattr__(self, attr: str):
+        value = getattr(self._load(), attr)
+        # Cache on the proxy so the next lookup skips __getattr__ entirely
+        self.__dict__[attr] = value
+        return value
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy_module(name: str) -> LazyModule:
+    """Return a LazyModule for `name` (the import happens on first use)."""
+    return LazyModule(name)
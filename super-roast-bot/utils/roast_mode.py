@@ -1,7 +1,8 @@
 """
 Roast Intensity Control — utils/roast_mode.py
 Provides selectable system prompts that control the tone of RoastBot.
-Drop-in safe: does not modify any existing module; imported only by app.py.
+Drop-in safe: does not modify any existing module; imported by app.py (prompts)
+and rag.py (mode tags for filtered retrieval).
 """
 
 ROAST_MODES: dict[str, str] = {
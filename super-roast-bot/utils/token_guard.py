@@ -12,6 +12,7 @@ Works with:
 PUBLIC API (unchanged from original):
   trim_chat_history(chat_history, tokenizer=None, max_tokens=3000)
   count_tokens(text, tokenizer=None)
+  tokenizer_name(tokenizer=None)
 """
 
 from __future__ import annotations
@@ -26,7 +27,6 @@ def _load_tokenizer():
     """Return tiktoken cl100k_base, or a word-count approximator as fallback."""
     try:
         import tiktoken  # type: ignore
-        return tiktoken.get_encoding("cl100k_base")
     except ImportError:
         warnings.warn(
             "tiktoken not installed — token guard uses word-count approximation "
@@ -35,10 +35,23 @@ def _load_tokenizer():
             stacklevel=3,
         )
         return _WordCountTokenizer()
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The BPE file is downloaded on first use; offline nodes can't fetch it
+        warnings.warn(
+            f"tiktoken could not load cl100k_base ({type(e).__name__}) — token guard "
+            "uses word-count approximation (1 word ≈ 1.3 tokens).",
+            RuntimeWarning,
+            stacklevel=3,
+        )
+        return _WordCountTokenizer()
 
 
 class _WordCountTokenizer:
     """Fallback: splits on whitespace and scales by ~1.3 to approximate tokens."""
+    name = "word-count"
+
     def encode(self, text: str) -> list[int]:
         return [0] * int(len(text.split()) * 1.3 + 0.5)
 
@@ -183,3 +196,14 @@ def count_tokens(text: str, tokenizer=None) -> int:
     if tokenizer is None:
         tokenizer = _get_tokenizer()
     return len(tokenizer.encode(text))
+
+
+def tokenizer_name(tokenizer=None) -> str:
+    """
+    Name of the tokenizer count_tokens() uses ("cl100k_base", or "word-count"
+    for the fallback). Token counts stored elsewhere (e.g. the RAG chunk
+    store) record it so they can be recomputed when it changes.
+    """
+    if tokenizer is None:
+        tokenizer = _get_tokenizer()
+    return getattr(tokenizer, "name", type(tokenizer).__name__)